@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+import glob
+import json
+import os
+import platform
+import random
+import shlex
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+LCW_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lcw.py")
+FAKE_LIGHTNINGD_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_lightningd.py")
+BENCH_FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_fixtures")
+FIXTURE_VERSION = 1
+RESULTS_VERSION = 1
+BLOCKHEIGHT = 700000
+TIMESTAMP = 1600000000
+
+# name: (channels of the benchmarked node, nodes in the network graph)
+PRESETS = {
+    "small": (10, 10000),
+    "large": (1000, 10000),
+    "huge": (10000, 100000),
+    "mainnet": (100, 100000),
+}
+
+# name: (lcw arguments, files removed from HOME before each run). Scenarios
+# without files to remove get one untimed run first to warm the caches.
+SCENARIOS = [
+    ("status-cold", ["-t"], [".lcwhistory.db"]),
+    ("status", ["-t"], []),
+    ("status-verbose", ["-t", "-v", "5"], []),
+    ("status-filter", ["-t", "-f", "total_payments > 10 and settle_rate > 0.5",
+                       "-s", "/routed_amount", "-l", "20"], []),
+    ("store", ["-t", "--command", "store"], []),
+    ("status-windows", ["-t", "--windows", "1,7,30", "--series"], []),
+    ("setfees", ["-t", "--command", "setfees", "--dry-run"], []),
+    ("analyze-cold", ["-t", "--command", "analyze", "--channels"], [".lcwgraph*.bin"]),
+    ("analyze-channels", ["-t", "--command", "analyze", "--channels"], []),
+    ("analyze-node", ["-t", "--command", "analyze", "--node", "self"], []),
+    ("analyze-bestnodes", ["-t", "--command", "analyze", "--bestnodes", "--approx", "-l", "10"], []),
+    ("analyze-bestpeers", ["-t", "--command", "analyze", "--bestpeers", "-l", "10"], []),
+]
+
+
+def node_id(rng):
+    return "{:02x}{:064x}".format(rng.choice((2, 3)), rng.getrandbits(256))
+
+
+def short_channel_id(rng):
+    return "{}x{}x{}".format(rng.randint(600000, BLOCKHEIGHT - 1000), rng.randint(1, 3000), rng.randint(0, 3))
+
+
+def write_json(path, content):
+    with open(path, "w") as file:
+        json.dump(content, file)
+
+
+def write_json_array(path, key, items):
+    # the network sized fixtures are written record by record
+    with open(path, "w") as file:
+        file.write('{{"{}": ['.format(key))
+        separator = "\n"
+        for item in items:
+            file.write(separator)
+            json.dump(item, file)
+            separator = ",\n"
+        file.write("\n]}\n")
+
+
+def channel_directions(rng, source, destination):
+    satoshis = rng.randint(20000, 16000000)
+    short_id = short_channel_id(rng)
+    for (a, b) in ((source, destination), (destination, source)):
+        yield {"source": a,
+               "destination": b,
+               "short_channel_id": short_id,
+               "public": True,
+               "satoshis": satoshis,
+               "amount_msat": "{}msat".format(satoshis * 1000),
+               "last_update": TIMESTAMP + rng.randint(0, 10000000),
+               "base_fee_millisatoshi": rng.choice((0, 1000)),
+               "fee_per_millionth": rng.choice((0, 1, 10, 100, 500, 2000)),
+               "active": rng.random() < 0.95}
+
+
+def network_edges(rng, nodes):
+    # preferential attachment between nodes 1..nodes-1: a few hubs and a
+    # long tail of small nodes, always connected
+    ends = [1]
+    for node in range(2, nodes):
+        for peer in set(rng.choice(ends) for _ in range(rng.choice((1, 1, 2, 2, 3, 5, 8)))):
+            yield (node, peer)
+            ends += [node, peer]
+
+
+def generate_fixtures(path, channels, nodes, seed):
+    rng = random.Random(seed)
+    tests = os.path.join(path, "tests")
+    os.makedirs(tests, exist_ok=True)
+    ids = [node_id(rng) for _ in range(nodes)]
+    me = ids[0]
+    peers = rng.sample(range(1, nodes), channels)
+
+    mine = []
+
+    def all_channels():
+        for (a, b) in network_edges(rng, nodes):
+            yield from channel_directions(rng, ids[a], ids[b])
+        for peer in peers:
+            for direction in channel_directions(rng, me, ids[peer]):
+                if direction["source"] == me:
+                    mine.append(direction)
+                yield direction
+
+    write_json_array(os.path.join(tests, "listchannels-all.txt"), "channels", all_channels())
+    write_json(os.path.join(tests, "listchannels.txt"), {"channels": mine})
+
+    funds = []
+    peer_channels = []
+    for channel in mine:
+        total = channel["satoshis"]
+        funds += [{"peer_id": channel["destination"],
+                   "short_channel_id": channel["short_channel_id"],
+                   "channel_sat": rng.randint(0, total),
+                   "channel_total_sat": total,
+                   "state": "CHANNELD_NORMAL"}]
+        (incoming, outgoing) = (rng.randint(0, 5000), rng.randint(0, 5000))
+        peer_channels += [{"id": channel["destination"],
+                           "connected": rng.random() < 0.9,
+                           "channels": [{"short_channel_id": channel["short_channel_id"],
+                                         "state": "CHANNELD_NORMAL",
+                                         "in_payments_offered": incoming + rng.randint(0, 500),
+                                         "out_payments_offered": outgoing + rng.randint(0, 500),
+                                         "in_payments_fulfilled": incoming,
+                                         "out_payments_fulfilled": outgoing,
+                                         "in_msatoshi_offered": incoming * 120000,
+                                         "out_msatoshi_offered": outgoing * 110000,
+                                         "in_msatoshi_fulfilled": incoming * 100000,
+                                         "out_msatoshi_fulfilled": outgoing * 90000}]}]
+    funds += [{"peer_id": ids[rng.randrange(1, nodes)],
+               "channel_sat": 1000000,
+               "channel_total_sat": 1000000,
+               "state": "CHANNELD_AWAITING_LOCKIN"}]
+    write_json(os.path.join(tests, "listfunds.txt"),
+               {"outputs": [{"value": 100000, "status": "confirmed"}, {"value": 5000, "status": "unconfirmed"}],
+                "channels": funds})
+    write_json(os.path.join(tests, "listpeers.txt"), {"peers": peer_channels})
+    write_json(os.path.join(tests, "getinfo.txt"),
+               {"id": me, "alias": "bench", "blockheight": BLOCKHEIGHT, "msatoshi_fees_collected": 123456789})
+    write_json_array(os.path.join(tests, "listnodes.txt"), "nodes",
+                     ({"nodeid": ids[node], "alias": "node{}".format(node)} for node in range(nodes)))
+
+
+def fixtures(root, preset, seed):
+    (channels, nodes) = PRESETS[preset]
+    path = os.path.join(root, "{}-{}".format(preset, seed))
+    stamp = {"version": FIXTURE_VERSION, "channels": channels, "nodes": nodes, "seed": seed}
+    stamp_path = os.path.join(path, "fixture.json")
+    if os.path.exists(stamp_path):
+        with open(stamp_path) as file:
+            if json.load(file) == stamp:
+                return (path, stamp)
+    print("generating {} fixtures: {} channels, {} nodes graph".format(preset, channels, nodes), file=sys.stderr)
+    start = time.perf_counter()
+    generate_fixtures(path, channels, nodes, seed)
+    write_json(stamp_path, stamp)
+    print("- done in {:.1f}s".format(time.perf_counter() - start), file=sys.stderr)
+    return (path, stamp)
+
+
+def run_lcw(fixture_path, home, args, timeout):
+    # one lcw process, timed with its own resource usage
+    env = dict(os.environ, HOME=home)
+    env.pop("LIGHTNING_RPC_FILE", None)
+    with tempfile.TemporaryFile() as errors:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, LCW_PATH, "--no-daemon"] + args, cwd=fixture_path, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=errors)
+        timed_out = False
+        while True:
+            (pid, status, usage) = os.wait4(process.pid, os.WNOHANG)
+            if pid != 0:
+                break
+            if time.perf_counter() - start > timeout:
+                process.kill()
+                (pid, status, usage) = os.wait4(process.pid, 0)
+                timed_out = True
+                break
+            time.sleep(0.002)
+        wall = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        errors.seek(0)
+        message = errors.read().decode(errors="replace").strip()
+    if timed_out:
+        return (wall, usage, "timeout after {}s".format(timeout))
+    if process.returncode != 0:
+        return (wall, usage, message or "exit status {}".format(process.returncode))
+    return (wall, usage, None)
+
+
+def start_server(fixture_path, home, server_args):
+    # fake_lightningd answering from the fixtures, for runs over the socket
+    path = os.path.join(home, "lightning-rpc")
+    process = subprocess.Popen([sys.executable, FAKE_LIGHTNINGD_PATH, "--fixtures", fixture_path] +
+                               shlex.split(server_args) + [path], stderr=subprocess.DEVNULL)
+    start = time.perf_counter()
+    while not os.path.exists(path):
+        if process.poll() is not None or time.perf_counter() - start > 10:
+            process.kill()
+            print("fake_lightningd did not start, try its arguments by hand: " + server_args)
+            exit(1)
+        time.sleep(0.01)
+    return (process, path)
+
+
+def socket_args(args, path):
+    return [arg for part in args for arg in (["--rpc-file", path] if part == "-t" else [part])]
+
+
+def max_rss_kb(usage):
+    if sys.platform == "darwin":
+        return usage.ru_maxrss // 1024
+    return usage.ru_maxrss
+
+
+def run_scenario(fixture_path, home, args, reset, repeat, timeout):
+    runs = []
+    rss = 0
+    if not reset:
+        (wall, usage, error) = run_lcw(fixture_path, home, args, timeout)
+        if error is not None:
+            return {"args": args, "error": error}
+    for _ in range(repeat):
+        for pattern in reset:
+            for path in glob.glob(os.path.join(home, pattern)):
+                os.unlink(path)
+        (wall, usage, error) = run_lcw(fixture_path, home, args, timeout)
+        if error is not None:
+            return {"args": args, "error": error}
+        runs += [round(wall, 4)]
+        rss = max(rss, max_rss_kb(usage))
+    return {"args": args,
+            "runs": runs,
+            "best": min(runs),
+            "median": statistics.median(runs),
+            "max_rss_kb": rss}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(LCW_PATH),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(result, reference, threshold):
+    # slower or bigger than the baseline by more than threshold
+    regressions = []
+    if result["median"] > reference["median"] * (1 + threshold):
+        regressions += ["time"]
+    if result["max_rss_kb"] > reference["max_rss_kb"] * (1 + threshold):
+        regressions += ["memory"]
+    return regressions
+
+
+def result_string(key, result, reference):
+    if "error" in result:
+        return "{:32} FAILED: {}".format(key, result["error"].splitlines()[-1])
+    line = "{:32} {:9.3f}s {:9.3f}s {:9.1f} MB".format(key, result["best"], result["median"],
+                                                        result["max_rss_kb"] / 1024)
+    if reference is not None and "error" not in reference:
+        line += "  {:+7.1%} {:+7.1%}".format(result["median"] / reference["median"] - 1,
+                                             result["max_rss_kb"] / reference["max_rss_kb"] - 1)
+    return line
+
+
+parser = OptionParser(usage="%prog [options]")
+
+parser.add_option("-p", "--presets",
+                  action="store", type="string", dest="presets", default="small,large",
+                  help="Comma separated fixture presets: " +
+                       ", ".join("{} ({} channels, {} nodes)".format(name, *size) for (name, size) in PRESETS.items()))
+
+parser.add_option("-s", "--scenarios",
+                  action="store", type="string", dest="scenarios", default=None,
+                  help="Comma separated scenarios, all by default: " +
+                       ", ".join(scenario[0] for scenario in SCENARIOS))
+
+parser.add_option("-r", "--repeat",
+                  action="store", type="int", dest="repeat", default=3,
+                  help="Runs of each scenario, the median is compared against the baseline")
+
+parser.add_option("", "--seed",
+                  action="store", type="int", dest="seed", default=1,
+                  help="Seed of the fixture generators")
+
+parser.add_option("", "--fixtures-dir",
+                  action="store", type="string", dest="fixtures_dir", default=BENCH_FIXTURES_PATH,
+                  help="Where generated fixtures are kept and reused")
+
+parser.add_option("", "--generate-only",
+                  action="store_true", dest="generate_only", default=False,
+                  help="Only generate the fixtures of the selected presets")
+
+parser.add_option("", "--timeout",
+                  action="store", type="int", dest="timeout", default=600,
+                  help="Seconds before a run is killed and its scenario marked failed")
+
+parser.add_option("", "--server",
+                  action="store", type="string", dest="server", default=None,
+                  help="Run over the socket of fake_lightningd.py started with these arguments, "
+                       "e.g. \"--latency 20 --jitter 10\", instead of reading the fixtures in test mode")
+
+parser.add_option("-o", "--output",
+                  action="store", type="string", dest="output", default="bench_results.json",
+                  help="Save the results as JSON to this file")
+
+parser.add_option("-b", "--baseline",
+                  action="store", type="string", dest="baseline", default=None,
+                  help="Compare against the results saved by a previous run")
+
+parser.add_option("", "--threshold",
+                  action="store", type="float", dest="threshold", default=0.2,
+                  help="Relative slowdown or memory growth against the baseline reported as a regression")
+
+
+def main():
+    (options, args) = parser.parse_args()
+
+    presets = options.presets.split(",")
+    for preset in presets:
+        if preset not in PRESETS:
+            print("unknown preset: " + preset)
+            exit(1)
+    scenarios = SCENARIOS
+    if options.scenarios is not None:
+        names = options.scenarios.split(",")
+        for name in names:
+            if name not in [scenario[0] for scenario in SCENARIOS]:
+                print("unknown scenario: " + name)
+                exit(1)
+        scenarios = [scenario for scenario in SCENARIOS if scenario[0] in names]
+
+    baseline = None
+    if options.baseline is not None:
+        try:
+            with open(options.baseline) as file:
+                baseline = json.load(file)
+        except (OSError, ValueError) as error:
+            print("cannot read baseline {}: {}".format(options.baseline, error))
+            exit(1)
+        if baseline.get("version") != RESULTS_VERSION:
+            print("unsupported baseline version in " + options.baseline)
+            exit(1)
+
+    fixture_paths = {preset: fixtures(options.fixtures_dir, preset, options.seed) for preset in presets}
+    if options.generate_only:
+        return
+
+    results = {"version": RESULTS_VERSION,
+               "date": int(time.time()),
+               "revision": git_revision(),
+               "python": platform.python_version(),
+               "platform": platform.platform(),
+               "cpus": os.cpu_count(),
+               "repeat": options.repeat,
+               "server": options.server,
+               "fixtures": {preset: stamp for (preset, (path, stamp)) in fixture_paths.items()},
+               "results": {}}
+
+    print("{:32} {:>10} {:>10} {:>12}".format("scenario", "best", "median", "max rss") +
+          ("  {:>7} {:>7}".format("time", "memory") if baseline is not None else ""))
+    if baseline is not None and baseline.get("server") != options.server:
+        print("warning: baseline ran with a different --server, comparing anyway", file=sys.stderr)
+    regressions = []
+    for preset in presets:
+        (fixture_path, stamp) = fixture_paths[preset]
+        if baseline is not None and baseline["fixtures"].get(preset) not in (None, stamp):
+            print("warning: baseline {} fixtures differ, comparing anyway".format(preset), file=sys.stderr)
+        home = tempfile.mkdtemp(prefix="lcwbench-")
+        server = None
+        try:
+            if options.server is not None:
+                (server, path) = start_server(fixture_path, home, options.server)
+            for (name, lcw_args, reset) in scenarios:
+                key = "{}/{}".format(preset, name)
+                if server is not None:
+                    lcw_args = socket_args(lcw_args, path)
+                result = run_scenario(fixture_path, home, lcw_args, reset, options.repeat, options.timeout)
+                results["results"][key] = result
+                reference = baseline["results"].get(key) if baseline is not None else None
+                print(result_string(key, result, reference))
+                if reference is not None and "error" not in reference and "error" not in result:
+                    regressions += ["{} ({})".format(key, ", ".join(kind))
+                                    for kind in [compare(result, reference, options.threshold)] if kind]
+                sys.stdout.flush()
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+            shutil.rmtree(home)
+
+    if options.output:
+        write_json(options.output, results)
+    failed = [key for (key, result) in results["results"].items() if "error" in result]
+    if failed:
+        print("failed: " + ", ".join(failed))
+    if regressions:
+        print("regressions over {:.0%}: {}".format(options.threshold, ", ".join(regressions)))
+    if failed or regressions:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
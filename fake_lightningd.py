@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+import json
+import os
+import random
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+import bench
+
+RECORDING_VERSION = 1
+RECV_SIZE = 65536
+SEND_SIZE = 65536
+UNKNOWN_COMMAND = -32601
+INJECTED_FAILURE = -1
+
+
+class RpcFailure(Exception):
+
+    def __init__(self, code, message):
+        self.code = code
+        self.message = message
+        Exception.__init__(self, message)
+
+
+def param(params, index, name):
+    # positional or named parameter of a request
+    if isinstance(params, dict):
+        return params.get(name)
+    return params[index] if len(params) > index else None
+
+
+class Fixtures:
+    # answers from the files of an lcw test fixture directory. Calls without
+    # parameters return the file as it is; filtered calls index it on first use.
+    FILES = {"getinfo": "getinfo", "listfunds": "listfunds", "listpeers": "listpeers",
+             "listnodes": "listnodes", "listchannels": "listchannels-all"}
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.texts = {}
+        self.nodes = None
+        self.channels = None
+        self.fees = {}
+
+    def text(self, name):
+        with self.lock:
+            if name not in self.texts:
+                with open(os.path.join(self.path, "tests", name + ".txt")) as file:
+                    self.texts[name] = file.read().strip()
+            return self.texts[name]
+
+    def node_index(self):
+        if self.nodes is None:
+            nodes = json.loads(self.text("listnodes"))["nodes"]
+            self.nodes = {node["nodeid"]: node for node in nodes}
+        return self.nodes
+
+    def channel_index(self):
+        # channels by source and by short channel id
+        if self.channels is None:
+            (by_source, by_id) = ({}, {})
+            for channel in json.loads(self.text("listchannels-all"))["channels"]:
+                by_source.setdefault(channel["source"], []).append(channel)
+                by_id.setdefault(channel["short_channel_id"], []).append(channel)
+            self.channels = (by_source, by_id)
+        return self.channels
+
+    def call(self, method, params):
+        # the result of a call as JSON text
+        if method == "listnodes" and param(params, 0, "id") is not None:
+            node = self.node_index().get(param(params, 0, "id"))
+            return json.dumps({"nodes": [node] if node is not None else []})
+        if method == "listchannels" and (param(params, 0, "short_channel_id") is not None or
+                                         param(params, 1, "source") is not None):
+            (by_source, by_id) = self.channel_index()
+            if param(params, 0, "short_channel_id") is not None:
+                channels = by_id.get(param(params, 0, "short_channel_id"), [])
+            else:
+                channels = by_source.get(param(params, 1, "source"), [])
+            return json.dumps({"channels": channels})
+        if method == "setchannelfee":
+            channel_id = param(params, 0, "id")
+            (base, ppm) = (param(params, 1, "base"), param(params, 2, "ppm"))
+            with self.lock:
+                self.fees[channel_id] = (base, ppm)
+            return json.dumps({"base": base, "ppm": ppm, "channels": [{"short_channel_id": channel_id}]})
+        if method in self.FILES:
+            return self.text(self.FILES[method])
+        raise RpcFailure(UNKNOWN_COMMAND, "Unknown command '{}'".format(method))
+
+
+class Recording:
+    # results of calls by method and parameters, replayed as they were
+    # recorded or collected from a real lightningd for later replay
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.results = {}
+        if os.path.exists(path):
+            with open(path) as file:
+                recording = json.load(file)
+            if recording.get("version") != RECORDING_VERSION:
+                print("unsupported recording version in " + path)
+                exit(1)
+            for call in recording["calls"]:
+                self.results[self.key(call["method"], call["params"])] = (call["method"], call["params"],
+                                                                          json.dumps(call["result"]))
+
+    @staticmethod
+    def key(method, params):
+        return json.dumps([method, params], sort_keys=True)
+
+    def get(self, method, params):
+        with self.lock:
+            entry = self.results.get(self.key(method, params))
+        return entry[2] if entry is not None else None
+
+    def add(self, method, params, result):
+        with self.lock:
+            self.results[self.key(method, params)] = (method, params, result)
+
+    def save(self):
+        with self.lock:
+            entries = list(self.results.values())
+        with open(self.path + ".tmp", "w") as file:
+            file.write('{{"version": {}, "calls": ['.format(RECORDING_VERSION))
+            separator = "\n"
+            for (method, params, result) in entries:
+                file.write('{}{{"method": {}, "params": {}, "result": {}}}'.format(
+                    separator, json.dumps(method), json.dumps(params), result))
+                separator = ",\n"
+            file.write("\n]}\n")
+        os.replace(self.path + ".tmp", self.path)
+
+
+def upstream_call(path, method, params):
+    # one request to a real lightningd, its raw result or error as JSON text
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    try:
+        sock.sendall(json.dumps({"jsonrpc": "2.0", "id": 0, "method": method, "params": params}).encode())
+        buffer = b""
+        while b"\n\n" not in buffer:
+            chunk = sock.recv(RECV_SIZE)
+            if not chunk:
+                raise RpcFailure(INJECTED_FAILURE, "upstream lightningd closed the connection")
+            buffer += chunk
+    finally:
+        sock.close()
+    response = json.loads(buffer[:buffer.index(b"\n\n")])
+    if "error" in response:
+        raise RpcFailure(response["error"].get("code", INJECTED_FAILURE), response["error"].get("message", ""))
+    return json.dumps(response["result"])
+
+
+def rate_spec(text, cast):
+    # "<default>[,<method>=<value>...]" as (default, {method: value})
+    (default, rates) = (cast(0), {})
+    for part in text.split(","):
+        if "=" in part:
+            (method, value) = part.split("=", 1)
+            rates[method] = cast(value)
+        elif part:
+            default = cast(part)
+    return (default, rates)
+
+
+class Behavior:
+    # what the server does to each request: delay, failure, dropped
+    # connection, and how fast the response goes out
+
+    def __init__(self, options):
+        self.latency = rate_spec(options.latency, float)
+        self.jitter = options.jitter
+        self.failures = rate_spec(options.fail, float)
+        self.drop = options.drop
+        self.bandwidth = options.bandwidth * 1000000
+        self.random = random.Random(options.seed)
+        self.lock = threading.Lock()
+
+    def draw(self, method):
+        # (delay in seconds, fail, drop)
+        with self.lock:
+            (jitter, fail, drop) = (self.random.random(), self.random.random(), self.random.random())
+        (latency, rates) = self.latency
+        (failure, failures) = self.failures
+        delay = (rates.get(method, latency) + jitter * self.jitter) / 1000
+        return (delay, fail < failures.get(method, failure), drop < self.drop)
+
+
+class Statistics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = {}
+
+    def add(self, method, seconds, size, outcome):
+        # per method: [requests, seconds, bytes, failed, dropped]
+        with self.lock:
+            entry = self.methods.setdefault(method, [0, 0.0, 0, 0, 0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] += size
+            entry[3] += outcome == "failed"
+            entry[4] += outcome == "dropped"
+
+    def report(self, file):
+        print("  {:20} {:>8} {:>10} {:>12} {:>7} {:>8}".format(
+            "method", "requests", "mean", "sent", "failed", "dropped"), file=file)
+        for (method, (count, seconds, size, failed, dropped)) in sorted(self.methods.items()):
+            print("- {:20} {:8d} {:9.3f}s {:9.1f} kB {:7d} {:8d}".format(
+                method, count, seconds / count, size / 1000, failed, dropped), file=file)
+
+
+class FakeLightningd(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    # lightningd's JSON-RPC over a unix socket: requests are JSON objects,
+    # each response is followed by an empty line. Every request is answered
+    # from its own thread, so pipelined requests can complete out of order.
+    daemon_threads = True
+
+    def __init__(self, path, fixtures, recording, upstream, behavior, verbose):
+        self.fixtures = fixtures
+        self.recording = recording
+        self.upstream = upstream
+        self.behavior = behavior
+        self.verbose = verbose
+        self.statistics = Statistics()
+        socketserver.UnixStreamServer.__init__(self, path, RpcHandler)
+
+    def result(self, method, params):
+        if self.upstream is not None:
+            result = upstream_call(self.upstream, method, params)
+            if self.recording is not None and method != "setchannelfee":
+                self.recording.add(method, params, result)
+            return result
+        if self.recording is not None:
+            result = self.recording.get(method, params)
+            if result is not None:
+                return result
+        if self.fixtures is not None:
+            return self.fixtures.call(method, params)
+        raise RpcFailure(UNKNOWN_COMMAND, "{} {} was not recorded".format(method, json.dumps(params)))
+
+
+class RpcHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        self.send_lock = threading.Lock()
+        self.closed = False
+        decoder = json.JSONDecoder()
+        buffer = ""
+        while not self.closed:
+            try:
+                chunk = self.request.recv(RECV_SIZE)
+            except OSError:
+                return
+            if not chunk:
+                return
+            buffer += chunk.decode()
+            while True:
+                buffer = buffer.lstrip()
+                try:
+                    (request, end) = decoder.raw_decode(buffer)
+                except ValueError:
+                    break
+                buffer = buffer[end:]
+                threading.Thread(target=self.answer, args=(request,), daemon=True).start()
+
+    def answer(self, request):
+        start = time.perf_counter()
+        method = request.get("method")
+        params = request.get("params", [])
+        (delay, fail, drop) = self.server.behavior.draw(method)
+        time.sleep(delay)
+        if drop:
+            self.closed = True
+            self.request.shutdown(socket.SHUT_RDWR)
+            self.server.statistics.add(method, time.perf_counter() - start, 0, "dropped")
+            return
+        outcome = "ok"
+        try:
+            if fail:
+                raise RpcFailure(INJECTED_FAILURE, "injected failure of " + method)
+            result = self.server.result(method, params)
+            response = '{{"jsonrpc": "2.0", "id": {}, "result": {}}}\n\n'.format(json.dumps(request.get("id")), result)
+        except (RpcFailure, OSError, ValueError) as e:
+            outcome = "failed"
+            error = {"code": getattr(e, "code", INJECTED_FAILURE), "message": str(e)}
+            response = json.dumps({"jsonrpc": "2.0", "id": request.get("id"), "error": error}) + "\n\n"
+        data = response.encode()
+        try:
+            with self.send_lock:
+                self.send(data)
+        except OSError:
+            outcome = "dropped"
+        elapsed = time.perf_counter() - start
+        self.server.statistics.add(method, elapsed, len(data), outcome)
+        if self.server.verbose:
+            print("{} {} {:.3f}s {} bytes {}".format(method, json.dumps(params), elapsed, len(data), outcome),
+                  file=sys.stderr)
+
+    def send(self, data):
+        bandwidth = self.server.behavior.bandwidth
+        if not bandwidth:
+            self.request.sendall(data)
+            return
+        for offset in range(0, len(data), SEND_SIZE):
+            piece = data[offset:offset + SEND_SIZE]
+            self.request.sendall(piece)
+            time.sleep(len(piece) / bandwidth)
+
+
+parser = OptionParser(usage="%prog [options] <socket path>")
+
+parser.add_option("", "--fixtures",
+                  action="store", type="string", dest="fixtures", default=None,
+                  help="Answer from the tests/*.txt files of this lcw fixture directory")
+
+parser.add_option("", "--generate",
+                  action="store", type="string", dest="generate", default=None,
+                  help="Answer from generated bench.py fixtures of this preset: " + ", ".join(bench.PRESETS))
+
+parser.add_option("", "--seed",
+                  action="store", type="int", dest="seed", default=1,
+                  help="Seed of the generated fixtures and of latency jitter and failures")
+
+parser.add_option("", "--fixtures-dir",
+                  action="store", type="string", dest="fixtures_dir", default=bench.BENCH_FIXTURES_PATH,
+                  help="Where generated fixtures are kept and reused")
+
+parser.add_option("", "--replay",
+                  action="store", type="string", dest="replay", default=None,
+                  help="Answer the calls recorded in this file, falling back to the fixtures")
+
+parser.add_option("", "--record",
+                  action="store", type="string", dest="record", default=None,
+                  help="Forward every call to --upstream and save the results to this file for --replay")
+
+parser.add_option("", "--upstream",
+                  action="store", type="string", dest="upstream", default=None,
+                  help="lightning-rpc socket of the real lightningd to record")
+
+parser.add_option("", "--latency",
+                  action="store", type="string", dest="latency", default="0",
+                  help="Milliseconds before each response: <default>[,<method>=<ms>...]")
+
+parser.add_option("", "--jitter",
+                  action="store", type="float", dest="jitter", default=0,
+                  help="Random extra latency of up to this many milliseconds")
+
+parser.add_option("", "--fail",
+                  action="store", type="string", dest="fail", default="0",
+                  help="Fraction of calls answered with an error: <default>[,<method>=<fraction>...]")
+
+parser.add_option("", "--drop",
+                  action="store", type="float", dest="drop", default=0,
+                  help="Fraction of calls that close the connection instead of answering")
+
+parser.add_option("", "--bandwidth",
+                  action="store", type="float", dest="bandwidth", default=0,
+                  help="Send responses at this many MB/s, unlimited by default")
+
+parser.add_option("-v", "--verbose",
+                  action="store_true", dest="verbose", default=False,
+                  help="Log every call to stderr")
+
+
+def main():
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_usage()
+        exit(1)
+    path = args[0]
+    if (options.record is None) != (options.upstream is None):
+        print("--record and --upstream go together")
+        exit(1)
+    try:
+        Behavior(options)
+    except ValueError:
+        print("--latency and --fail expect <default>[,<method>=<value>...]")
+        exit(1)
+
+    fixtures = None
+    if options.generate is not None:
+        if options.generate not in bench.PRESETS:
+            print("unknown preset: " + options.generate)
+            exit(1)
+        (fixture_path, stamp) = bench.fixtures(options.fixtures_dir, options.generate, options.seed)
+        fixtures = Fixtures(fixture_path)
+    elif options.fixtures is not None:
+        fixtures = Fixtures(options.fixtures)
+    recording = None
+    if options.record is not None:
+        recording = Recording(options.record)
+    elif options.replay is not None:
+        recording = Recording(options.replay)
+    if fixtures is None and recording is None:
+        print("nothing to serve: use --fixtures, --generate, --replay or --record")
+        exit(1)
+
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            print("a server is already listening on " + path)
+            exit(1)
+        except OSError:
+            os.unlink(path)
+        finally:
+            probe.close()
+    server = FakeLightningd(path, fixtures, recording, options.upstream, Behavior(options), options.verbose)
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    print("fake lightningd serving on {}".format(path), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+        if options.record is not None:
+            recording.save()
+            print("{} calls recorded in {}".format(len(recording.results), options.record), file=sys.stderr)
+        server.statistics.report(sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
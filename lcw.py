@@ -1,20 +1,82 @@
 #!/usr/bin/env python3
 
+import codecs
+import contextlib
+import csv
+import heapq
+import importlib
+import io
+import itertools
 import json
+import operator
 import re
+import signal
+import socket
+import socketserver
+import sqlite3
 import string
 import sys
-import subprocess
 import os
-import munch
+import threading
 import time
 from optparse import OptionParser
 
+
+class LazyModule:
+    # a module imported on first use, replacing this placeholder in the
+    # globals, for the imports that only some commands need and that would
+    # otherwise dominate the start-up time of the cheap ones
+    def __init__(self, name, module):
+        self.__dict__.update(name=name, module=module)
+
+    def __getattr__(self, attribute):
+        importlib.import_module(self.module)
+        module = sys.modules[self.module.split(".")[0]]
+        globals()[self.name] = module
+        return getattr(module, attribute)
+
+
+concurrent = LazyModule("concurrent", "concurrent.futures")
+cProfile = LazyModule("cProfile", "cProfile")
+hashlib = LazyModule("hashlib", "hashlib")
+multiprocessing = LazyModule("multiprocessing", "multiprocessing")
+munch = LazyModule("munch", "munch")
+np = LazyModule("np", "numpy")
+resource = LazyModule("resource", "resource")
+shlex = LazyModule("shlex", "shlex")
+subprocess = LazyModule("subprocess", "subprocess")
+tempfile = LazyModule("tempfile", "tempfile")
+tracemalloc = LazyModule("tracemalloc", "tracemalloc")
+
 SATS_PER_BTC = 100000000
 CLI_LIGHTNING_COMMAND = None
+CLI_LIGHTNING_COMMAND_VARNAME = "CLI_LIGHTNING_COMMAND"
+LIGHTNING_RPC_FILE_VARNAME = "LIGHTNING_RPC_FILE"
+LCW_TIMINGS_FILE_VARNAME = "LCW_TIMINGS_FILE"
+clapi = None
 DAY = 86400
 NOW = int(time.time())
 LCW_DATA_PATH = os.getenv("HOME") + "/.lcwdata.json"
+LCW_HISTORY_PATH = os.getenv("HOME") + "/.lcwhistory.db"
+LCW_GRAPH_PATH = os.getenv("HOME") + "/.lcwgraph.bin"
+LCW_TEST_GRAPH_PATH = os.getenv("HOME") + "/.lcwgraph-test-{}.bin"
+LCW_DAEMON_PATH = os.getenv("HOME") + "/.lcwd.sock"
+LCW_FLEET_HISTORY_PATH = os.getenv("HOME") + "/.lcwhistory-{}.db"
+GRAPH_SNAPSHOT_MAGIC = b"LCWGRAPH"
+GRAPH_SNAPSHOT_VERSION = 1
+GRAPH_SNAPSHOT_HEADER = 4096
+SETFEES_WORKERS = 8
+SETFEES_RETRIES = 3
+SETFEES_RETRY_DELAY = 0.5
+DEFAULT_BASE_FEE = 0
+FEE_SWEEP_CELLS = 1 << 22
+BIT_SUMS_ROWS = 4096
+STREAM_CHUNK_SIZE = 65536
+ALIAS_CACHE_TTL = DAY
+ALIAS_WORKERS = 8
+DAEMON_STALE_REFRESHES = 3
+JSON_DECODER = json.JSONDecoder()
+WORKER_GRAPH = None
 
 
 # Verbosity
@@ -42,21 +104,27 @@ class ConditionOp:
     OP_GREATER_OR_EQUAL = ">="
     OP_LOWER = "<"
     OP_LOWER_OR_EQUAL = "<="
+    OP_MATCH = "~"
+    OP_NOT_MATCH = "!~"
     OP_TRUE = "any"
     OP_FALSE = "none"
 
-
-def eval_arg(obj, arg):
-    if arg is None:
-        return None
-    try:
-        return float(arg)
-    except Exception:
-        if arg in obj:
-            return obj[arg]
-        else:
-            return arg
-    # return arg
+    COMPARE = {
+        "=": operator.eq,
+        "==": operator.eq,
+        "<>": operator.ne,
+        "!=": operator.ne,
+        ">": operator.gt,
+        ">=": operator.ge,
+        "<": operator.lt,
+        "<=": operator.le,
+    }
+    ARITHMETIC = {
+        "+": operator.add,
+        "-": operator.sub,
+        "*": operator.mul,
+        "/": operator.truediv,
+    }
 
 
 class StateFilter:
@@ -68,59 +136,247 @@ class StateFilter:
         self.op = op
 
 
-class ObjCondition:
+class FilterError(ValueError):
+    pass
+
+
+class FilterParser:
+    # expression grammar of a filter, loosest binding first:
+    #   or, and, not, comparison (= <> != < <= > >= ~ !~), + -, * /, unary -
+    # Words are numbers when they parse as one, fields when the object has
+    # them, string literals otherwise. Quoted strings are always literals.
+    TOKEN = re.compile(r"\s*(?:('[^']*'|\"[^\"]*\")|([\w.]+)|(<>|!=|==|<=|>=|!~|[=<>~()+\-*/]))")
+    PATTERN = re.compile(r"\s*(?:('[^']*'|\"[^\"]*\")|([^\s()]+))")
+
     def __init__(self, string):
-        self.left = None
-        self.right = None
-        self.op = ConditionOp.OP_TRUE
-        regexp = re.compile("([\w]+)$")
-        m = regexp.match(string)
-        if m:
-            self.left = None
-            self.right = None
-            self.op = string
-            return
-        regexp = re.compile("([\w]+)[\s]*([<>=]+)[\s]*([\w]+)$")
-        m = regexp.match(string)
-        if m:
-            self.left = m.group(1)
-            self.op = m.group(2)
-            self.right = m.group(3)
-            return
-        print("malformed object condition: " + string)
+        self.string = string
+        (self.tokens, self.texts) = self.tokenize(string)
+        self.position = 0
+
+    def tokenize(self, string):
+        # the tokens, and each of them as it was written for error messages
+        tokens = []
+        texts = []
+        offset = 0
+        while string[offset:].strip():
+            if tokens and tokens[-1] in (("op", ConditionOp.OP_MATCH), ("op", ConditionOp.OP_NOT_MATCH)):
+                m = self.PATTERN.match(string, offset)
+                if m is None:
+                    raise FilterError("unexpected '{}' in pattern, quote patterns containing parentheses".format(
+                        string[offset:].strip()[0]))
+                (quoted, pattern) = m.groups()
+                if quoted is not None:
+                    pattern = quoted[1:-1]
+                elif pattern[0] in "'\"":
+                    raise FilterError("unterminated quote at {}".format(string[offset:].strip()))
+                tokens += [("pattern", pattern)]
+                texts += [m.group(0).strip()]
+                offset = m.end()
+                continue
+            m = self.TOKEN.match(string, offset)
+            if m is None and string[offset:].strip()[0] in "'\"":
+                raise FilterError("unterminated quote at {}".format(string[offset:].strip()))
+            if m is None:
+                raise FilterError("unexpected character at '{}'".format(string[offset:].strip()))
+            (quoted, word, op) = m.groups()
+            if quoted is not None:
+                tokens += [("string", quoted[1:-1])]
+            elif word is not None:
+                try:
+                    tokens += [("number", float(word))]
+                except ValueError:
+                    if word in (StateFilter.OR, StateFilter.AND, StateFilter.NOT):
+                        tokens += [("op", word)]
+                    else:
+                        tokens += [("word", word)]
+            else:
+                tokens += [("op", op)]
+            texts += [m.group(0).strip()]
+            offset = m.end()
+        return (tokens, texts)
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def text(self):
+        return self.texts[self.position] if self.position < len(self.texts) else ""
+
+    def take(self, *ops):
+        (kind, value) = self.peek()
+        if kind == "op" and value in ops:
+            self.position += 1
+            return value
+        return None
 
-    def exec(self, obj):
-        if self.op == ConditionOp.OP_TRUE:
-            return True
-        elif self.op == ConditionOp.OP_FALSE:
-            return False
-        left = eval_arg(obj, self.left)
-        right = eval_arg(obj, self.right)
+    def parse(self):
+        if not self.tokens:
+            raise FilterError("empty expression")
+        node = self.parse_or()
+        if self.position < len(self.tokens):
+            raise FilterError("unexpected '{}'".format(self.text()))
+        return node
+
+    def parse_or(self):
+        node = self.parse_and()
+        while self.take(StateFilter.OR):
+            node = ("or", node, self.parse_and())
+        return node
+
+    def parse_and(self):
+        node = self.parse_not()
+        while self.take(StateFilter.AND):
+            node = ("and", node, self.parse_not())
+        return node
+
+    def parse_not(self):
+        if self.take(StateFilter.NOT):
+            return ("not", self.parse_not())
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        node = self.parse_sum()
+        op = self.take(*ConditionOp.COMPARE)
+        if op is not None:
+            return ("compare", op, node, self.parse_sum())
+        op = self.take(ConditionOp.OP_MATCH, ConditionOp.OP_NOT_MATCH)
+        if op is not None:
+            (kind, pattern) = self.peek()
+            if kind != "pattern":
+                raise FilterError("missing pattern after '{}'".format(op))
+            self.position += 1
+            return ("match", op, node, pattern)
+        return node
+
+    def parse_sum(self):
+        node = self.parse_product()
+        op = self.take("+", "-")
+        while op is not None:
+            node = ("arithmetic", op, node, self.parse_product())
+            op = self.take("+", "-")
+        return node
+
+    def parse_product(self):
+        node = self.parse_unary()
+        op = self.take("*", "/")
+        while op is not None:
+            node = ("arithmetic", op, node, self.parse_unary())
+            op = self.take("*", "/")
+        return node
+
+    def parse_unary(self):
+        if self.take("-"):
+            return ("arithmetic", "-", ("constant", 0.0), self.parse_unary())
+        if self.take("("):
+            node = self.parse_or()
+            if not self.take(")"):
+                raise FilterError("missing ')'")
+            return node
+        (kind, value) = self.peek()
+        if kind in ("number", "string"):
+            self.position += 1
+            return ("constant", value)
+        if kind == "word":
+            self.position += 1
+            return ("word", value)
+        raise FilterError("missing operand" if kind is None else "unexpected '{}'".format(self.text()))
+
+
+def compile_filter(node, fields):
+    # returns (constant, value): either a value known at compile time or a
+    # function of the filtered object
+    kind = node[0]
+    if kind == "constant":
+        return (True, node[1])
+    if kind == "word":
+        if node[1] in fields:
+            return (False, operator.attrgetter(node[1]))
+        return (True, node[1])
+    if kind in ("compare", "arithmetic"):
+        function = (ConditionOp.COMPARE if kind == "compare" else ConditionOp.ARITHMETIC)[node[1]]
+        (left_constant, left) = compile_filter(node[2], fields)
+        (right_constant, right) = compile_filter(node[3], fields)
+        if left_constant and right_constant:
+            try:
+                return (True, function(left, right))
+            except (TypeError, ZeroDivisionError):
+                return (True, None if kind == "arithmetic" else False)
+        if left_constant:
+            (left_value, left) = (left, lambda obj: left_value)
+        if right_constant:
+            (right_value, right) = (right, lambda obj: right_value)
+        if kind == "arithmetic":
+            return (False, lambda obj: function(left(obj), right(obj)))
+
+        def compare(obj):
+            try:
+                return function(left(obj), right(obj))
+            except (TypeError, ZeroDivisionError):
+                return False
+        return (False, compare)
+    if kind == "match":
         try:
-            if self.op == ConditionOp.OP_EQUAL:
-                return left == right
-            elif self.op == ConditionOp.OP_NOT_EQUAL:
-                return left != right
-            elif self.op == ConditionOp.OP_GREATER:
-                return left > right
-            elif self.op == ConditionOp.OP_GREATER_OR_EQUAL:
-                return left >= right
-            elif self.op == ConditionOp.OP_LOWER:
-                return left < right
-            elif self.op == ConditionOp.OP_LOWER_OR_EQUAL:
-                return left <= right
-            else:
+            search = re.compile(node[3]).search
+        except re.error as e:
+            raise FilterError("bad pattern '{}': {}".format(node[3], e))
+        expected = node[1] == ConditionOp.OP_MATCH
+        (constant, value) = compile_filter(node[2], fields)
+        if constant:
+            return (True, (search(str(value)) is not None) == expected)
+
+        def match(obj):
+            try:
+                found = value(obj)
+            except (TypeError, ZeroDivisionError):
                 return False
-        except Exception:
-            return False
-
-
-# class ObjFilter:
-#     def __init__(self, string):
-#         pass
+            return found is not None and (search(str(found)) is not None) == expected
+        return (False, match)
+    if kind == "not":
+        (constant, value) = compile_filter(("test", node[1]), fields)
+        if constant:
+            return (True, not value)
+        return (False, lambda obj: not value(obj))
+    if kind in ("and", "or"):
+        (left_constant, left) = compile_filter(("test", node[1]), fields)
+        (right_constant, right) = compile_filter(("test", node[2]), fields)
+        if left_constant:
+            return (right_constant, right) if left == (kind == "and") else (True, left)
+        if right_constant:
+            if right == (kind == "and"):
+                return (False, left)
+            return (True, right)
+        if kind == "and":
+            return (False, lambda obj: left(obj) and right(obj))
+        return (False, lambda obj: left(obj) or right(obj))
+    if kind == "test":
+        # truth value of a sub-expression used as a condition
+        inner = node[1]
+        if inner[0] == "word" and inner[1] not in fields:
+            if inner[1] == ConditionOp.OP_TRUE:
+                return (True, True)
+            if inner[1] == ConditionOp.OP_FALSE:
+                return (True, False)
+            raise FilterError("unknown field '{}'".format(inner[1]))
+        (constant, value) = compile_filter(inner, fields)
+        if constant:
+            return (True, bool(value))
+        if inner[0] in ("compare", "match", "not", "and", "or"):
+            return (False, value)
+
+        def test(obj):
+            try:
+                return bool(value(obj))
+            except (TypeError, ZeroDivisionError):
+                return False
+        return (False, test)
+    raise FilterError("unknown node {}".format(kind))
 
 
 class FilterPipe:
+    # a sequence of filters applied in order: +<expression> selects the
+    # objects matching it, -<expression> drops them, and the "or", "and" and
+    # "not" steps stop on, or invert, the result so far
     def __init__(self):
         self.filters = []
 
@@ -135,60 +391,467 @@ class FilterPipe:
             sign = ConditionSign.PLUS
             condition = string
         condition = condition.strip()
-        filter = None
-        if condition == StateFilter.OR:
-            filter = StateFilter(StateFilter.OR)
-        elif condition == StateFilter.AND:
-            filter = StateFilter(StateFilter.AND)
-        elif condition == StateFilter.NOT:
-            filter = StateFilter(StateFilter.NOT)
-        if filter is not None:
-            self.filters += [filter]
+        if condition in (StateFilter.OR, StateFilter.AND, StateFilter.NOT):
+            self.filters += [StateFilter(condition)]
         else:
-            self.filters += [(sign, ObjCondition(condition))]
-
-    def exec(self, obj):
-        result = True
-        for filter in self.filters:
-            if isinstance(filter, StateFilter):
-                if filter.op == StateFilter.OR:
-                    if result:
-                        return True
-                elif filter.op == StateFilter.AND:
-                    if not result:
-                        return False
-                elif filter.op == StateFilter.NOT:
-                    result = not result
-            else:
-                (sign, condition) = filter
-                condition_result = condition.exec(obj)
-                if sign == ConditionSign.PLUS and condition_result:
-                    result = True
-                elif sign == ConditionSign.MINUS and condition_result:
-                    result = False
-        return result
+            try:
+                self.filters += [(sign, condition, FilterParser(condition).parse())]
+            except FilterError as e:
+                raise FilterError("malformed filter '{}': {}".format(string, e))
+
+    def compile(self, fields):
+        # fold the whole pipe into one predicate, from the last step back
+        def done(obj, result):
+            return result
+        step = done
+        for filter in reversed(self.filters):
+            step = self.compile_step(filter, fields, step)
+        if step is done:
+            return lambda obj: True
+        return lambda obj: step(obj, True)
+
+    def compile_step(self, filter, fields, next_step):
+        if isinstance(filter, StateFilter):
+            if filter.op == StateFilter.OR:
+                return lambda obj, result: True if result else next_step(obj, result)
+            elif filter.op == StateFilter.AND:
+                return lambda obj, result: next_step(obj, result) if result else False
+            return lambda obj, result: next_step(obj, not result)
+        (sign, condition, node) = filter
+        try:
+            (constant, test) = compile_filter(("test", node), fields)
+        except FilterError as e:
+            raise FilterError("malformed filter '{}': {}".format(condition, e))
+        outcome = sign == ConditionSign.PLUS
+        if constant:
+            if not test:
+                return next_step
+            return lambda obj, result: next_step(obj, outcome)
+        return lambda obj, result: next_step(obj, outcome if test(obj) else result)
 
 
 def file_content(path):
     try:
+        start = time.perf_counter()
         file = open(path, mode="r")
         content = file.read()
         file.close()
-        return json.loads(content)
+        parse_start = time.perf_counter()
+        result = json.loads(content)
+        end = time.perf_counter()
+        TIMINGS.add_call(os.path.splitext(os.path.basename(path))[0], "file", end - start, end - parse_start,
+                         len(content))
+        return result
     except Exception:
         print("file not found: " + path)
         return None
 
 
-def cli_query(params):
+def cli_query_command():
     global CLI_LIGHTNING_COMMAND
-    if CLI_LIGHTNING_COMMAND is None:
-        CLI_LIGHTNING_COMMAND_VARNAME = "CLI_LIGHTNING_COMMAND"
-        CLI_LIGHTNING_COMMAND = os.getenv(CLI_LIGHTNING_COMMAND_VARNAME)
-        if not CLI_LIGHTNING_COMMAND:
-            print("{} env var is not set!".format(CLI_LIGHTNING_COMMAND_VARNAME))
-            exit(1)
-    return json.loads(subprocess.check_output([CLI_LIGHTNING_COMMAND] + params))
+    CLI_LIGHTNING_COMMAND = os.getenv(CLI_LIGHTNING_COMMAND_VARNAME)
+    if not CLI_LIGHTNING_COMMAND:
+        print("{} env var is not set!".format(CLI_LIGHTNING_COMMAND_VARNAME))
+        exit(1)
+
+
+def cli_query(params, command=None):
+    # command: lightning-cli and its options as a list, $CLI_LIGHTNING_COMMAND by default
+    if command is None:
+        if CLI_LIGHTNING_COMMAND is None:
+            cli_query_command()
+        command = [CLI_LIGHTNING_COMMAND]
+    start = time.perf_counter()
+    output = subprocess.check_output(command + params)
+    parse_start = time.perf_counter()
+    result = json.loads(output)
+    end = time.perf_counter()
+    TIMINGS.add_call(params[0], "cli", end - start, end - parse_start, len(output))
+    return result
+
+
+def cli_chunks(params, command=None):
+    # stdout of lightning-cli, chunk by chunk as it is produced
+    global CLI_LIGHTNING_COMMAND
+    if command is None:
+        if CLI_LIGHTNING_COMMAND is None:
+            cli_query_command()
+        command = [CLI_LIGHTNING_COMMAND]
+    process = subprocess.Popen(command + params, stdout=subprocess.PIPE)
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    completed = False
+    try:
+        while True:
+            chunk = process.stdout.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                completed = True
+                break
+            yield decoder.decode(chunk)
+        yield decoder.decode(b"", final=True)
+    finally:
+        process.stdout.close()
+        process.wait()
+    if completed and process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command + params)
+
+
+def file_chunks(path):
+    try:
+        file = open(path, mode="r")
+    except Exception:
+        print("file not found: " + path)
+        return
+    with file:
+        while True:
+            chunk = file.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+class JsonStream:
+    # incremental reader over a JSON document arriving in text chunks
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ""
+        self.position = 0
+        self.done = False
+
+    def fill(self):
+        for chunk in self.chunks:
+            self.buffer = self.buffer[self.position:] + chunk
+            self.position = 0
+            return True
+        self.done = True
+        return False
+
+    def peek(self):
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in " \t\r\n":
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.fill():
+                return ""
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("malformed JSON stream: expected '{}' at '{}'".format(
+                char, self.buffer[self.position:self.position + 20]))
+        self.position += 1
+
+    def value(self):
+        # a value is only accepted once more input follows it, so that a
+        # number split across two chunks is not cut short
+        self.peek()
+        while True:
+            try:
+                (value, end) = JSON_DECODER.raw_decode(self.buffer, self.position)
+                if end < len(self.buffer) or self.done:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.done:
+                    raise
+            self.fill()
+
+
+def iter_json_array(chunks, path, fields=None):
+    # yield the elements of the array found under the keys in path one at a
+    # time, keeping only the given fields
+    stream = JsonStream(chunks)
+    for key in path:
+        stream.expect("{")
+        while True:
+            if stream.peek() == "}":
+                raise ValueError("key '{}' not found in JSON stream".format(key))
+            name = stream.value()
+            stream.expect(":")
+            if name == key:
+                break
+            value = stream.value()
+            if name == "error":
+                raise RpcError("request", value)
+            if stream.peek() == ",":
+                stream.position += 1
+    stream.expect("[")
+    if stream.peek() == "]":
+        return
+    while True:
+        record = stream.value()
+        if fields is not None:
+            record = {field: record[field] for field in fields if field in record}
+        yield record
+        separator = stream.peek()
+        stream.expect(separator if separator in ",]" else ",")
+        if separator == "]":
+            return
+
+
+def cli_param(param):
+    if param is None:
+        return "null"
+    return str(param)
+
+
+class RpcError(Exception):
+
+    def __init__(self, method, error):
+        self.method = method
+        self.error = error
+        Exception.__init__(self, "{} failed: {}".format(method, error.get("message", error)))
+
+
+class LightningRpc:
+    # JSON-RPC client over the lightningd unix socket. The connection is opened
+    # once and shared by every call; requests are tagged with an id so several
+    # threads can have requests in flight and each waits for its own response.
+    # A broken connection is dropped: the requests sent on it fail and the
+    # next call connects again. generation counts the connections.
+    RECV_SIZE = 65536
+
+    def __init__(self, path):
+        self.path = path
+        self.socket = None
+        self.generation = 0
+        self.next_id = 0
+        self.buffer = b""
+        self.buffer_generation = 0
+        self.scanned = 0
+        self.responses = {}
+        self.sent = {}
+        self.reading = False
+        self.send_lock = threading.Lock()
+        self.cond = threading.Condition()
+
+    def connect(self):
+        if self.socket is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.path)
+            self.socket = sock
+        return self.socket
+
+    def close(self):
+        with self.cond:
+            self.reset(self.generation)
+
+    def reset(self, generation):
+        # drop the connection of that generation, unless it is already gone
+        with self.cond:
+            if generation != self.generation:
+                return
+            self.generation += 1
+            if self.socket is not None:
+                try:
+                    # wakes up a reader blocked on it
+                    self.socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                self.socket.close()
+                self.socket = None
+            self.cond.notify_all()
+
+    def send(self, method, params):
+        with self.send_lock:
+            self.next_id += 1
+            request_id = self.next_id
+            request = {"jsonrpc": "2.0", "id": request_id, "method": method, "params": params}
+            with self.cond:
+                sock = self.connect()
+                generation = self.generation
+            self.sent[request_id] = (time.perf_counter(), generation)
+            try:
+                sock.sendall(json.dumps(request).encode())
+            except OSError:
+                self.sent.pop(request_id)
+                self.reset(generation)
+                raise
+        return request_id
+
+    def read_message(self, sock):
+        # lightningd terminates every response with an empty line and JSON
+        # strings cannot hold raw newlines, so the separator is unambiguous.
+        # Returns the response with its size and parse time.
+        while True:
+            end = self.buffer.find(b"\n\n", self.scanned)
+            if end >= 0:
+                message = self.buffer[:end]
+                self.buffer = self.buffer[end + 2:]
+                self.scanned = 0
+                if message.strip():
+                    start = time.perf_counter()
+                    response = json.loads(message)
+                    return (response, len(message), time.perf_counter() - start)
+                continue
+            self.scanned = max(len(self.buffer) - 1, 0)
+            chunk = sock.recv(self.RECV_SIZE)
+            if not chunk:
+                raise ConnectionError("lightningd closed the rpc connection")
+            self.buffer += chunk
+
+    def wait(self, request_id, method=""):
+        with self.cond:
+            while request_id not in self.responses:
+                if self.sent[request_id][1] != self.generation:
+                    self.sent.pop(request_id)
+                    raise ConnectionError("lightningd closed the rpc connection")
+                if self.reading:
+                    self.cond.wait()
+                    continue
+                self.reading = True
+                (sock, generation) = (self.socket, self.generation)
+                if self.buffer_generation != generation:
+                    (self.buffer, self.scanned, self.buffer_generation) = (b"", 0, generation)
+                self.cond.release()
+                message = None
+                try:
+                    message = self.read_message(sock)
+                except OSError:
+                    pass
+                finally:
+                    self.cond.acquire()
+                    self.reading = False
+                    self.cond.notify_all()
+                if message is None:
+                    # every waiter on this connection wakes up and raises
+                    self.reset(generation)
+                    continue
+                self.responses[message[0].get("id")] = message
+                self.cond.notify_all()
+            (response, size, parse) = self.responses.pop(request_id)
+        TIMINGS.add_call(method, "socket", time.perf_counter() - self.sent.pop(request_id)[0], parse, size)
+        if "error" in response:
+            raise RpcError(method, response["error"])
+        return response["result"]
+
+    def call(self, method, params=None):
+        return self.wait(self.send(method, params if params is not None else []), method)
+
+    def stream(self, method, params, path, fields=None):
+        # large responses are read on a connection of their own and parsed
+        # while they arrive, so pipelined calls on the shared one don't wait
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        request = {"jsonrpc": "2.0", "id": 0, "method": method, "params": params}
+        sock.sendall(json.dumps(request).encode())
+        try:
+            yield from timed_records(method, "socket", socket_chunks(sock), ["result"] + path, fields)
+        except RpcError as e:
+            raise RpcError(method, e.error)
+        finally:
+            sock.close()
+
+    def batch(self, calls):
+        # pipeline: write every request before reading the first response
+        request_ids = [(self.send(method, params), method) for (method, params) in calls]
+        return [self.wait(request_id, method) for (request_id, method) in request_ids]
+
+
+def timed_call(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+class Timings:
+    # wall time of the phases of a run and of every lightningd call, with the
+    # bytes received and the time spent parsing them. Always recorded, shown
+    # by --timings and appended to --timings-file.
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.calls = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        with self.lock:
+            entry = self.phases.setdefault(name, [0, 0.0, 0.0])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                entry[0] += 1
+                entry[1] += elapsed
+                entry[2] = max(entry[2], elapsed)
+
+    def add_call(self, method, transport, seconds, parse, size):
+        # per method and transport: [calls, seconds, max seconds, parse seconds, bytes]
+        with self.lock:
+            entry = self.calls.setdefault((method, transport), [0, 0.0, 0.0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+            entry[3] += parse
+            entry[4] += size
+
+    def report(self, file):
+        print("Timings: {:.3f}s".format(time.perf_counter() - self.start), file=file)
+        print("  {:28} {:>6} {:>9} {:>9}".format("phase", "calls", "total", "max"), file=file)
+        for (name, (calls, total, longest)) in self.phases.items():
+            print("- {:28} {:6d} {:8.3f}s {:8.3f}s".format(name, calls, total, longest), file=file)
+        print("  {:20} {:9} {:>6} {:>9} {:>9} {:>9} {:>11}".format(
+            "rpc", "transport", "calls", "total", "max", "parse", "received"), file=file)
+        for ((method, transport), (calls, total, longest, parse, size)) in self.calls.items():
+            print("- {:20} {:9} {:6d} {:8.3f}s {:8.3f}s {:8.3f}s {:8.1f} kB".format(
+                method, transport, calls, total, longest, parse, size / 1000), file=file)
+
+    def record(self, argv):
+        # one JSON line per run for --timings-file
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return {"time": NOW,
+                "argv": argv,
+                "total": round(time.perf_counter() - self.start, 6),
+                "cpu": round(usage.ru_utime + usage.ru_stime, 6),
+                "max_rss_kb": usage.ru_maxrss,
+                "phases": {name: {"calls": calls, "total": round(total, 6), "max": round(longest, 6)}
+                           for (name, (calls, total, longest)) in self.phases.items()},
+                "rpc": [{"method": method, "transport": transport, "calls": calls, "total": round(total, 6),
+                         "max": round(longest, 6), "parse": round(parse, 6), "bytes": size}
+                        for ((method, transport), (calls, total, longest, parse, size))
+                        in self.calls.items()]}
+
+
+TIMINGS = Timings()
+
+
+def timed_records(method, transport, chunks, path, fields=None):
+    # iter_json_array recording the call: time spent waiting for the chunks
+    # and parsing them, not the time the caller spends on each record
+    received = [0, 0.0]
+
+    def counted_chunks():
+        iterator = iter(chunks)
+        try:
+            while True:
+                start = time.perf_counter()
+                chunk = next(iterator, None)
+                received[1] += time.perf_counter() - start
+                if chunk is None:
+                    return
+                received[0] += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()
+
+    records = iter_json_array(counted_chunks(), path, fields)
+    inside = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            record = next(records, None)
+            inside += time.perf_counter() - start
+            if record is None:
+                return
+            yield record
+    finally:
+        records.close()
+        TIMINGS.add_call(method, transport, inside, inside - received[1], received[0])
 
 
 def age_string(timestamp):
@@ -209,44 +872,77 @@ def age_string2(age_days):
         return "{:2d} months".format((days + 15) // 30)
 
 
-def peer_id_string(alias, peer_id, verbosity):
-    filtered_alias = filter_alias(alias)
-    if verbosity == 5:
-        return "{:24.24} {}".format(filtered_alias, peer_id)
-    elif verbosity == 1:
-        return "{:12.12} {}...".format(
-            filtered_alias,
-            peer_id[:4],
-        )
-    else:
-        return "{:16.16} {}...{}".format(
-            filtered_alias,
-            peer_id[:8],
-            peer_id[-8:],
-        )
-
-
-def capacity_string(input, output, verbosity):
-    BAR_CHAR = "="
-    total = input + output
-    if verbosity <= 3:
-        input_bars = round(input / total * 10)
-        output_bars = round(output / total * 10)
-        return "{:>10.10}|{:<10.10} {:11.8f}".format(
-            BAR_CHAR * input_bars,
-            BAR_CHAR * output_bars,
-            total / SATS_PER_BTC
-        )
-    else:
-        input_str = "{:10.8f}".format(
-            input / SATS_PER_BTC) if input else "          "
-        output_str = "{:10.8f}".format(
-            output / SATS_PER_BTC) if output else "          "
-        return "{}-{}  {:10.8f}".format(
-            input_str,
-            output_str,
-            total / SATS_PER_BTC
-        )
+def fee_policy(out_ratio, k, offset, max_ppm):
+    # ppm fees of the --fees rule for channels with these out_ratio:
+    # k / out_ratio + offset rounded to tens and capped at max_ppm, max_ppm
+    # when nothing is on our side. Scalar parameters give one fee per channel,
+    # arrays of grid points give shape (points, channels).
+    k = np.asarray(k, dtype=np.float64)[..., np.newaxis]
+    offset = np.asarray(offset, dtype=np.float64)[..., np.newaxis]
+    max_ppm = np.asarray(max_ppm, dtype=np.float64)[..., np.newaxis]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ppm_fee = np.minimum(np.round(k / out_ratio + offset, -1), max_ppm)
+    return np.where(out_ratio == 0, max_ppm, ppm_fee).astype(np.int64)
+
+
+def sweep_values(text):
+    # comma separated values or inclusive start:stop:step ranges
+    values = []
+    for part in text.split(","):
+        bounds = [int(bound) for bound in part.split(":")]
+        if len(bounds) == 1:
+            values += bounds
+        elif len(bounds) in (2, 3) and (len(bounds) == 2 or bounds[2] > 0):
+            values += range(bounds[0], bounds[1] + 1, bounds[2] if len(bounds) == 3 else 1)
+        else:
+            raise ValueError(part)
+    return values
+
+
+class ChannelRows:
+    # rows of the status table. The peer and capacity columns of a verbosity
+    # level are folded into one format string, so a row is a single format
+    # call, with a second format for channels without a settle rate. Its
+    # positional fields: 0 short_id, 1 alias, 2 peer_id, 3 end of peer_id,
+    # 4 input, 5 output, 6 total capacity, 7 payments, 8 total_payments, 9 age,
+    # 10 tx_per_day, 11 routed_capacity, 12 settle_rate, 13 state,
+    # 14 base_fee_msat, 15 ppm_fee
+    BARS = ["=" * count for count in range(11)]
+    PAYMENTS = "{:4d}-{:<d}".format
+    CAPACITY = "{:10.8f}".format
+    NO_CAPACITY = " " * 10
+
+    def __init__(self, verbosity):
+        if verbosity == 5:
+            peer = "{1:24.24} {2}"
+        elif verbosity == 1:
+            peer = "{1:12.12} {2:.4}..."
+        else:
+            peer = "{1:16.16} {2:.8}...{3}"
+        self.bars = verbosity <= 3
+        if self.bars:
+            capacity = "{4:>10.10}|{5:<10.10} {6:11.8f}"
+        else:
+            capacity = "{4}-{5}  {6:10.8f}"
+        row = ("- {0:13s}  " + peer + "  " + capacity +
+               "  {7:8s} {8:4d}  {9}  {10:5.1f}  {11:6.2f}  {12}  {13} ({14}/{15})\n")
+        self.format = row.replace("{12}", "{12:5.1f}%").format
+        self.format_no_settle = row.replace("{12}", "  n/a ").format
+
+    def row(self, channel):
+        (input, output) = (channel.input_capacity, channel.output_capacity)
+        total = input + output
+        if self.bars:
+            (input, output) = (self.BARS[round(input / total * 10)], self.BARS[round(output / total * 10)])
+        else:
+            input = self.CAPACITY(input / SATS_PER_BTC) if input else self.NO_CAPACITY
+            output = self.CAPACITY(output / SATS_PER_BTC) if output else self.NO_CAPACITY
+        row = self.format if channel.settle_rate is not None else self.format_no_settle
+        return row(channel.short_id, filter_alias(channel.alias), channel.peer_id, channel.peer_id[-8:],
+                   input, output, total / SATS_PER_BTC,
+                   self.PAYMENTS(channel.in_payments, channel.out_payments), channel.total_payments,
+                   age_string2(channel.age), channel.tx_per_day, channel.routed_capacity, channel.settle_rate,
+                   channel.state, channel.base_fee_msat, channel.ppm_fee)
 
 
 def day(days_ago=0):
@@ -257,87 +953,502 @@ def timestamp_from_day(day):
     return int(time.mktime(time.strptime(day + " 00:00:00", '%Y%m%d %H:%M:%S')))
 
 
-def filter_alias(alias):
-    result = ""
-    for ch in alias:
-        if ch in string.printable:
-            result += ch
+class HistoryStore:
+    # daily snapshots of the channel counters that --since needs, one row
+    # per (day, channel), plus the ignored channels and the alias cache.
+    # Replaces the JSON file at LCW_DATA_PATH, which is imported once when
+    # the store is created.
+    VERSION = 2
+    COUNTERS = ("in_payments", "out_payments",
+                "in_msatoshi_fulfilled", "out_msatoshi_fulfilled",
+                "in_payments_offered", "out_payments_offered",
+                "in_msatoshi_offered", "out_msatoshi_offered")
+
+    def __init__(self, path=LCW_HISTORY_PATH, legacy_path=LCW_DATA_PATH):
+        # check_same_thread: the daemon builds nodes and serves them from different threads
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version > self.VERSION:
+            print("unsupported history store version {} in {}".format(version, path))
+            exit(1)
+        if version == 0:
+            self.create(legacy_path)
+        if version < self.VERSION:
+            self.upgrade()
+
+    def create(self, legacy_path):
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            if self.db.execute("PRAGMA user_version").fetchone()[0] != 0:
+                return
+            self.db.execute("CREATE TABLE days (day INTEGER PRIMARY KEY)")
+            self.db.execute("CREATE TABLE counters (day INTEGER, channel_id TEXT, {}, "
+                            "PRIMARY KEY (day, channel_id)) WITHOUT ROWID".format(
+                                ", ".join("{} INTEGER".format(name) for name in self.COUNTERS)))
+            self.db.execute("CREATE TABLE ignored (channel_id TEXT PRIMARY KEY) WITHOUT ROWID")
+            if legacy_path is not None and os.path.exists(legacy_path):
+                self.migrate(legacy_path)
+            self.db.execute("PRAGMA user_version = 1")
+
+    def upgrade(self):
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            version = self.db.execute("PRAGMA user_version").fetchone()[0]
+            if version < 2:
+                self.db.execute("CREATE TABLE aliases (node_id TEXT PRIMARY KEY, alias TEXT, updated INTEGER) "
+                                "WITHOUT ROWID")
+            self.db.execute("PRAGMA user_version = {}".format(self.VERSION))
+
+    def migrate(self, legacy_path):
+        # a legacy file that cannot be read or imported is skipped with a
+        # warning, and nothing of it is kept
+        self.db.execute("SAVEPOINT migrate")
+        try:
+            with open(legacy_path) as file:
+                stored_json = json.load(file)
+            for (day, channels) in stored_json.get("history", {}).items():
+                self.insert(day, channels)
+            for channel_id in stored_json.get("ignored", []):
+                self.db.execute("INSERT OR IGNORE INTO ignored VALUES (?)", (channel_id,))
+        except (OSError, ValueError, AttributeError, TypeError, sqlite3.Error) as e:
+            self.db.execute("ROLLBACK TO migrate")
+            print("cannot import history from {}, skipped: {}".format(legacy_path, e), file=sys.stderr)
+            return
+        finally:
+            self.db.execute("RELEASE migrate")
+        print("imported {} days of history from {}".format(len(stored_json.get("history", {})), legacy_path),
+              file=sys.stderr)
+
+    def insert(self, day, channels):
+        self.db.execute("INSERT INTO days VALUES (?)", (int(day),))
+        self.db.executemany("INSERT INTO counters VALUES ({})".format(", ".join("?" * (len(self.COUNTERS) + 2))),
+                            [(int(day), channel_id) + tuple(channel.get(name) for name in self.COUNTERS)
+                             for (channel_id, channel) in channels.items()])
+
+    def store(self, day, channels):
+        # False when the day is already stored
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            if self.db.execute("SELECT 1 FROM days WHERE day = ?", (int(day),)).fetchone():
+                return False
+            self.insert(day, channels)
+        return True
+
+    def reference(self, day):
+        # counters of every channel on that day, None when it was not stored
+        if not self.db.execute("SELECT 1 FROM days WHERE day = ?", (int(day),)).fetchone():
+            return None
+        rows = self.db.execute("SELECT channel_id, {} FROM counters WHERE day = ?".format(
+            ", ".join(self.COUNTERS)), (int(day),))
+        return {row[0]: {name: value for (name, value) in zip(self.COUNTERS, row[1:]) if value is not None}
+                for row in rows}
+
+    def nearest_day(self, day):
+        # the stored day closest to day, the older one on a tie
+        before = self.db.execute("SELECT MAX(day) FROM days WHERE day <= ?", (int(day),)).fetchone()[0]
+        after = self.db.execute("SELECT MIN(day) FROM days WHERE day >= ?", (int(day),)).fetchone()[0]
+        if before is None or after is None:
+            nearest = before if after is None else after
+        elif timestamp_from_day(str(after)) - timestamp_from_day(day) < timestamp_from_day(day) - timestamp_from_day(str(before)):
+            nearest = after
         else:
-            result += "!"
-    return result
+            nearest = before
+        return None if nearest is None else str(nearest)
+
+    def counter_arrays(self, channel_ids, days):
+        # counters of the given channels on the given days, shaped
+        # (days, channels, counters). A channel missing on a day did not
+        # exist yet and counts as 0; counters that were not recorded are NaN.
+        counters = np.zeros((len(days), len(channel_ids), len(self.COUNTERS)))
+        channel_index = {channel_id: i for (i, channel_id) in enumerate(channel_ids)}
+        day_index = {int(day): i for (i, day) in enumerate(days)}
+        rows = self.db.execute("SELECT day, channel_id, {} FROM counters WHERE day IN ({})".format(
+            ", ".join(self.COUNTERS), ", ".join("?" * len(day_index))), list(day_index))
+        for row in rows:
+            if row[1] in channel_index:
+                counters[day_index[row[0]], channel_index[row[1]]] = np.array(row[2:], dtype=np.float64)
+        return counters
+
+    def history(self):
+        # every stored day with the counters of every channel ever stored,
+        # shaped (days, channels, counters), and which rows exist
+        days = [row[0] for row in self.db.execute("SELECT day FROM days ORDER BY day")]
+        channel_ids = [row[0] for row in self.db.execute("SELECT DISTINCT channel_id FROM counters")]
+        counters = np.full((len(days), len(channel_ids), len(self.COUNTERS)), np.nan)
+        present = np.zeros((len(days), len(channel_ids)), dtype=bool)
+        channel_index = {channel_id: i for (i, channel_id) in enumerate(channel_ids)}
+        day_index = {day: i for (i, day) in enumerate(days)}
+        for row in self.db.execute("SELECT day, channel_id, {} FROM counters".format(", ".join(self.COUNTERS))):
+            (i, j) = (day_index[row[0]], channel_index[row[1]])
+            counters[i, j] = np.array(row[2:], dtype=np.float64)
+            present[i, j] = True
+        return [str(day) for day in days], channel_ids, counters, present
+
+    def ignored(self):
+        return [row[0] for row in self.db.execute("SELECT channel_id FROM ignored")]
+
+    def aliases(self, node_ids, since):
+        # cached aliases of node_ids updated after since, and the node ids
+        # that are missing or older. A node without alias maps to None.
+        found = {}
+        node_ids = list(node_ids)
+        for offset in range(0, len(node_ids), 500):
+            chunk = node_ids[offset:offset + 500]
+            found.update((row[0], row[1]) for row in self.db.execute(
+                "SELECT node_id, alias FROM aliases WHERE updated > ? AND node_id IN ({})".format(
+                    ", ".join("?" * len(chunk))), [since] + chunk))
+        return (found, [node_id for node_id in node_ids if node_id not in found])
+
+    def store_aliases(self, aliases, updated):
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.executemany("INSERT OR REPLACE INTO aliases VALUES (?, ?, ?)",
+                                [(node_id, alias, updated) for (node_id, alias) in aliases.items()])
+
+    def ignore(self, channel_id):
+        with self.db:
+            self.db.execute("INSERT OR IGNORE INTO ignored VALUES (?)", (channel_id,))
+
+
+def counter_stats(deltas):
+    # payments, routed amount (sats) and settle rate from counter deltas
+    # shaped (..., HistoryStore.COUNTERS)
+    payments = deltas[..., 0] + deltas[..., 1]
+    amount = (deltas[..., 2] + deltas[..., 3]) / 1000
+    offered = deltas[..., 4] + deltas[..., 5]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        settle_rate = np.where(offered > 0, payments / offered * 100, np.nan)
+    return payments, amount, settle_rate
+
+
+def stats_string(payments, amount, settle_rate):
+    return "{:6.0f} {:11.8f} {}".format(payments,
+                                        amount / SATS_PER_BTC,
+                                        "{:5.1f}%".format(settle_rate) if not np.isnan(settle_rate) else "  n/a ")
+
+
+class AliasTable(dict):
+    # str.translate table of filter_alias: printable ASCII is kept, anything
+    # else shows as "!". Filled as characters are met.
+    def __missing__(self, code):
+        self[code] = code if chr(code) in string.printable else ord("!")
+        return self[code]
+
+
+ALIAS_TABLE = AliasTable()
+
+
+def filter_alias(alias):
+    return alias.translate(ALIAS_TABLE)
+
+
+def socket_chunks(sock):
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    while True:
+        chunk = sock.recv(STREAM_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
 
 
 class CLightning:
 
-    def __init__(self, test_mode=False):
+    def __init__(self, test_mode=False, rpc_file=None, cli_command=None):
         self.test_mode = test_mode
+        self.rpc = LightningRpc(rpc_file) if rpc_file else None
+        self.cli_command = cli_command
+        self.test_nodes = None
+        self.test_lock = threading.Lock()
+
+    def query(self, method, params=None):
+        params = params if params is not None else []
+        if self.rpc is not None:
+            return self.rpc.call(method, params)
+        return cli_query([method] + [cli_param(param) for param in params], self.cli_command)
 
     def getinfo(self):
-        if self.test_mode:
+        if self.test_mode and self.rpc is None:
             return file_content("tests/getinfo.txt")
         else:
-            return cli_query(['getinfo'])
+            return self.query("getinfo")
 
     def listfunds(self):
-        if self.test_mode:
+        if self.test_mode and self.rpc is None:
             return file_content("tests/listfunds.txt")
         else:
-            return cli_query(['listfunds'])
+            return self.query("listfunds")
 
-    def listchannels(self, short_channel_id="null", source_node_id="null"):
-        if self.test_mode:
-            if source_node_id == "null":
+    def listchannels(self, short_channel_id=None, source_node_id=None):
+        if self.test_mode and self.rpc is None:
+            if source_node_id is None:
                 return file_content("tests/listchannels-all.txt")
             else:
                 return file_content("tests/listchannels.txt")
         else:
-            return cli_query(['listchannels', short_channel_id, source_node_id])
+            return self.query("listchannels", [short_channel_id, source_node_id])
 
     def listpeers(self):
-        if self.test_mode:
+        if self.test_mode and self.rpc is None:
             return file_content("tests/listpeers.txt")
         else:
-            return cli_query(["listpeers"])
+            return self.query("listpeers")
+
+    def listnodes(self, node_id=None):
+        if self.test_mode and self.rpc is None:
+            if node_id is None:
+                return file_content("tests/listnodes.txt")
+            node = self.test_node(node_id)
+            return {"nodes": [node] if node is not None else []}
+        elif node_id is None:
+            return self.query("listnodes")
+        else:
+            return self.query("listnodes", [node_id])
+
+    def test_node(self, node_id):
+        # listnodes <id> from the fixture, indexed on first use
+        with self.test_lock:
+            if self.test_nodes is None:
+                self.test_nodes = {node["nodeid"]: node for node in file_content("tests/listnodes.txt")["nodes"]}
+        return self.test_nodes.get(node_id)
+
+    def stream(self, method, params, path, fields):
+        if self.rpc is not None:
+            return self.rpc.stream(method, params, path, fields)
+        return timed_records(method, "cli", cli_chunks([method] + [cli_param(param) for param in params],
+                                                       self.cli_command), path, fields)
+
+    def iter_listchannels(self, fields=None):
+        if self.test_mode and self.rpc is None:
+            return timed_records("listchannels-all", "file", file_chunks("tests/listchannels-all.txt"),
+                                 ["channels"], fields)
+        else:
+            return self.stream("listchannels", [], ["channels"], fields)
 
-    def listnodes(self):
-        if self.test_mode:
-            return file_content("tests/listnodes.txt")
+    def iter_listnodes(self, fields=None):
+        if self.test_mode and self.rpc is None:
+            return timed_records("listnodes", "file", file_chunks("tests/listnodes.txt"), ["nodes"], fields)
         else:
-            return cli_query(["listnodes"])
+            return self.stream("listnodes", [], ["nodes"], fields)
 
     def setchannelfee(self, id, base, ppm):
-        if self.test_mode:
+        if self.test_mode and self.rpc is None:
             return {}
         else:
-            return cli_query(["setchannelfee", id, str(base), str(ppm)])
+            return self.query("setchannelfee", [id, base, ppm])
+
+
+def load_aliases(api):
+    aliases = {}
+    for node in api.iter_listnodes(("nodeid", "alias")):
+        if "alias" in node:
+            aliases[node["nodeid"]] = node["alias"]
+    return aliases
+
+
+def node_alias(api, node_id):
+    nodes = api.listnodes(node_id)["nodes"]
+    if nodes and "alias" in nodes[0]:
+        return nodes[0]["alias"]
+    return None
+
+
+def cached_aliases(api, history, node_ids):
+    # aliases of node_ids from the cache, asking lightningd only for the
+    # missing or stale ones, one listnodes <id> call each. Without a
+    # history store every alias is asked for and nothing is cached.
+    if history is not None:
+        with TIMINGS.phase("aliases.cache"):
+            (aliases, missing) = history.aliases(set(node_ids), NOW - ALIAS_CACHE_TTL)
+    else:
+        (aliases, missing) = ({}, list(set(node_ids)))
+    if missing:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=ALIAS_WORKERS) as executor:
+            fetched = dict(zip(missing, executor.map(node_alias, itertools.repeat(api), missing)))
+        if history is not None:
+            history.store_aliases(fetched, NOW)
+        aliases.update(fetched)
+    return {node_id: alias for (node_id, alias) in aliases.items() if alias is not None}
+
+
+class Channel:
+    # one of Node.channels. Filters and --sort refer to these field names.
+    __slots__ = ("peer_id", "short_id", "alias", "state", "new_channel",
+                 "input_capacity", "output_capacity", "total_capacity",
+                 "last_update", "base_fee_msat", "ppm_fee",
+                 "in_payments_offered", "out_payments_offered",
+                 "in_payments", "out_payments",
+                 "in_msatoshi_fulfilled", "out_msatoshi_fulfilled",
+                 "in_msatoshi_offered", "out_msatoshi_offered",
+                 "total_payments", "total_payments_offered", "settle_rate",
+                 "routed_amount", "routed_capacity",
+                 "funding_block", "age", "tx_per_day")
+
+    def __init__(self, peer_id, short_id, input_capacity, output_capacity, state, new_channel):
+        self.peer_id = peer_id
+        self.short_id = short_id
+        self.alias = "?"
+        self.state = state
+        self.new_channel = new_channel
+        self.input_capacity = input_capacity
+        self.output_capacity = output_capacity
+        self.total_capacity = input_capacity + output_capacity
+        self.last_update = NOW
+        self.base_fee_msat = 0
+        self.ppm_fee = 0
+        self.in_payments_offered = 0
+        self.out_payments_offered = 0
+        self.in_payments = 0
+        self.out_payments = 0
+        self.in_msatoshi_fulfilled = 0
+        self.out_msatoshi_fulfilled = 0
+        self.in_msatoshi_offered = 0
+        self.out_msatoshi_offered = 0
+        self.total_payments = 0
+        self.total_payments_offered = None
+        self.settle_rate = None
+        self.routed_amount = 0
+        self.routed_capacity = 0
+        self.funding_block = None
+        self.age = None
+        self.tx_per_day = None
 
 
 class Node:
+    # api: the CLightning of this node, clapi by default
 
-    def __init__(self, since=None):
+    def __init__(self, since=None, api=None, history_path=LCW_HISTORY_PATH, legacy_path=LCW_DATA_PATH):
+        self.api = api if api is not None else clapi
         self.date_ref = None
         self.since = None
         self.ref_data = None
-        self.ignored_channels = []
-        data_stored = file_content(LCW_DATA_PATH)
-        if data_stored is not None:
-            if "ignored" in data_stored:
-                self.ignored_channels = data_stored["ignored"]
+        with TIMINGS.phase("node.history"):
+            self.history = HistoryStore(history_path, legacy_path)
+            # aliases read from test fixtures stay out of the cache real runs use
+            self.alias_cache = None if self.api.test_mode and self.api.rpc is None else self.history
+            self.ignored_channels = self.history.ignored()
             if since is not None:
-                history = data_stored["history"]
-                self.date_ref = day(since)
-                if self.date_ref in history:
-                    self.ref_data = history[self.date_ref]
+                # the closest stored day when there is no snapshot for that day
+                self.date_ref = self.history.nearest_day(day(since))
+                if self.date_ref is not None:
+                    self.ref_data = self.history.reference(self.date_ref)
                     self.period = (NOW - timestamp_from_day(self.date_ref)) / 86400
-                    self.since = since
-        self.getinfo = clapi.getinfo()
-        self.id = self.getinfo["id"]
+                    self.since = int(self.period)
+        self.rpc_latency = {}
+
+    # RPC results are fetched on first access, and the channels and totals
+    # derived from them on first access of any of them. Commands that know
+    # what they need call prefetch() or refresh() to fetch it all at once.
+    RPC_RESULTS = {"getinfo": "getinfo",
+                   "listfunds": "listfunds",
+                   "listchannels": "listchannels",
+                   "listpeers": "listpeers",
+                   "hashed_listnodes": "listnodes"}
+    CHANNEL_RPCS = ("getinfo", "listfunds", "listchannels", "listpeers")
+    DERIVED = {"inputs", "channels", "counters", "block_height", "fees_collected",
+               "wallet_value_confirmed", "wallet_value_unconfirmed", "total_wallet",
+               "input_capacity", "output_capacity", "total", "routed_amount", "channel_count",
+               "in_payments", "out_payments", "all_last_updates"}
+
+    def __getattr__(self, name):
+        if name == "id":
+            return self.getinfo["id"]
+        if name in self.RPC_RESULTS:
+            self.prefetch(self.RPC_RESULTS[name])
+        elif name in self.DERIVED:
+            self.refresh()
+        else:
+            raise AttributeError(name)
+        return self.__dict__[name]
+
+    def loaded(self, name):
+        return name in self.__dict__
+
+    def prefetch(self, *names):
+        with TIMINGS.phase("node.fetch"):
+            rpc = self.fetch(names)
+        if "listnodes" in rpc:
+            self.set_aliases(rpc.pop("listnodes"))
+        self.__dict__.update(rpc)
+
+    def fetch(self, names):
+        # only listchannels depends on another call (it needs our node id), so
+        # everything else is issued at once and listchannels follows getinfo
+        # until the id is known
+        calls = {"getinfo": self.api.getinfo,
+                 "listfunds": self.api.listfunds,
+                 "listpeers": self.api.listpeers,
+                 "listnodes": self.all_aliases}
+        rpc = {}
+        if len(names) == 1 and names[0] in calls:
+            rpc[names[0]] = self.rpc_result(names[0], timed_call(calls[names[0]]))
+            return rpc
+        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
+            pending = {name: executor.submit(timed_call, calls[name]) for name in names if name in calls}
+            if "listchannels" in names:
+                if self.loaded("getinfo"):
+                    node_id = self.getinfo["id"]
+                elif "getinfo" in pending:
+                    rpc["getinfo"] = self.rpc_result("getinfo", pending.pop("getinfo"))
+                    node_id = rpc["getinfo"]["id"]
+                else:
+                    node_id = self.id
+                pending["listchannels"] = executor.submit(timed_call, self.api.listchannels, source_node_id=node_id)
+            if "aliases" in names:
+                # aliases of our peers only, they follow listfunds
+                if self.loaded("listfunds"):
+                    funds = self.listfunds
+                else:
+                    rpc["listfunds"] = self.rpc_result("listfunds", pending.pop("listfunds"))
+                    funds = rpc["listfunds"]
+                peer_ids = [channel_data["peer_id"] for channel_data in funds["channels"]]
+                pending["aliases"] = executor.submit(timed_call, cached_aliases, self.api, self.alias_cache, peer_ids)
+            for (name, result) in pending.items():
+                rpc[name] = self.rpc_result(name, result)
+        return rpc
+
+    def refresh(self, aliases=False):
+        with TIMINGS.phase("node.fetch"):
+            rpc = self.fetch(self.CHANNEL_RPCS + (("aliases",) if aliases else ()))
+        with TIMINGS.phase("node.update"):
+            self.update(rpc)
+
+    def all_aliases(self):
+        # the whole listnodes table, also used to refill the alias cache
+        aliases = load_aliases(self.api)
+        if self.alias_cache is not None:
+            self.alias_cache.store_aliases(aliases, NOW)
+        return aliases
+
+    def set_aliases(self, aliases):
+        self.hashed_listnodes = aliases
+        if self.loaded("channels"):
+            for channel in self.channels.values():
+                if channel.peer_id in aliases:
+                    channel.alias = aliases[channel.peer_id]
+
+    def update(self, rpc):
+        # apply new RPC results: only the channels whose inputs changed are
+        # rebuilt, and the node totals move by their difference
+        if not self.loaded("inputs"):
+            self.inputs = {}
+            self.channels = {}
+            self.counters = {}
+            self.block_height = None
+            self.input_capacity = 0
+            self.output_capacity = 0
+            self.routed_amount = 0
+            self.channel_count = 0
+            self.in_payments = 0
+            self.out_payments = 0
+        self.getinfo = rpc["getinfo"]
+        self.listfunds = rpc["listfunds"]
+        self.listchannels = rpc["listchannels"]
+        self.listpeers = rpc["listpeers"]
+        new_aliases = "listnodes" in rpc or "aliases" in rpc
+        if new_aliases:
+            self.hashed_listnodes = rpc.get("listnodes", rpc.get("aliases"))
         self.fees_collected = self.getinfo["msatoshi_fees_collected"] / 1000
-        self.listfunds = clapi.listfunds()
-        self.listchannels = clapi.listchannels(source_node_id=self.id)
-        self.listpeers = clapi.listpeers()
-        self.channels = {}
-        self.all_last_updates = []
 
         self.wallet_value_confirmed = 0
         self.wallet_value_unconfirmed = 0
@@ -348,134 +1459,152 @@ class Node:
                 self.wallet_value_unconfirmed += output["value"]
         self.total_wallet = self.wallet_value_confirmed + self.wallet_value_unconfirmed
 
-        self.input_capacity = 0
-        self.output_capacity = 0
-        self.routed_amount = 0
-        self.channel_count = 0
-        self.in_payments = 0
-        self.out_payments = 0
-        self.new_channels = 0
+        new_block = self.getinfo["blockheight"] != self.block_height
         self.block_height = self.getinfo["blockheight"]
+        with TIMINGS.phase("node.join"):
+            inputs = self.channel_inputs()
+        for channel_id in self.inputs:
+            if channel_id not in inputs:
+                self.remove_channel(channel_id)
+        for (channel_id, channel_inputs) in inputs.items():
+            if self.inputs.get(channel_id) != channel_inputs:
+                if channel_id in self.inputs:
+                    self.remove_channel(channel_id)
+                self.add_channel(channel_id, channel_inputs)
+            else:
+                channel = self.channels[channel_id]
+                if channel_inputs[5] is None:
+                    # no gossip yet: updated as of this refresh, as for a new channel
+                    channel.last_update = NOW
+                if new_block:
+                    self.set_age(channel)
+                if new_aliases and channel.peer_id in self.hashed_listnodes:
+                    channel.alias = self.hashed_listnodes[channel.peer_id]
+        self.inputs = inputs
+        # listfunds order
+        self.channels = {channel_id: self.channels[channel_id] for channel_id in inputs}
+        self.total = self.input_capacity + self.output_capacity
+        self.all_last_updates = [channel_inputs[5][0] for channel_inputs in inputs.values()
+                                 if channel_inputs[5] is not None]
+
+    def channel_inputs(self):
+        # per channel: (peer id, total sats, our sats, state, new channel,
+        # (last update, base fee, ppm fee) from listchannels, counters from listpeers)
+        inputs = {}
+        new_channels = 0
         for channel_data in self.listfunds["channels"]:
-            self.channel_count += 1
-            total = channel_data["channel_total_sat"]
-            output = channel_data["channel_sat"]
-            input = total - output
             if "short_channel_id" in channel_data:
                 short_channel_id = channel_data["short_channel_id"]
                 new_channel = False
             else:
-                short_channel_id = "new-" + str(self.new_channels)
-                self.new_channels += 1
+                short_channel_id = "new-" + str(new_channels)
+                new_channels += 1
                 new_channel = True
-            channel = munch.Munch(peer_id=channel_data["peer_id"],
-                                  short_id=short_channel_id,
-                                  input_capacity=input,
-                                  output_capacity=output,
-                                  total_capacity=input + output,
-                                  state=channel_data["state"],
-                                  last_update=NOW,
-                                  in_payments_offered=0,
-                                  out_payments_offered=0,
-                                  in_payments=0,
-                                  out_payments=0,
-                                  in_msatoshi_fulfilled=0,
-                                  out_msatoshi_fulfilled=0,
-                                  in_msatoshi_offered=0,
-                                  out_msatoshi_offered=0,
-                                  new_channel=new_channel,
-                                  total_payments=0,
-                                  base_fee_msat=0,
-                                  ppm_fee=0,
-                                  alias="?",
-                                  routed_amount=0,
-                                  routed_capacity=0,
-                                  total_payments_offered=None,
-                                  settle_rate=None)
-            self.channels[short_channel_id] = channel
-            self.input_capacity += input
-            self.output_capacity += output
-        self.total = self.input_capacity + self.output_capacity
+            inputs[short_channel_id] = [channel_data["peer_id"],
+                                        channel_data["channel_total_sat"],
+                                        channel_data["channel_sat"],
+                                        channel_data["state"],
+                                        new_channel,
+                                        None,
+                                        None]
         for channel_data in self.listchannels["channels"]:
             channel_id = channel_data["short_channel_id"]
-            if channel_id not in self.channels:
+            if channel_id not in inputs:
                 print("unknown channel {} in listfunds".format(channel_id))
                 continue
-            channel = self.channels[channel_id]
-            channel.last_update = channel_data["last_update"]
-            self.all_last_updates += [channel.last_update]
-            channel.base_fee_msat = channel_data["base_fee_millisatoshi"]
-            channel.ppm_fee = channel_data["fee_per_millionth"]
+            inputs[channel_id][5] = (channel_data["last_update"],
+                                     channel_data["base_fee_millisatoshi"],
+                                     channel_data["fee_per_millionth"])
         for peer_data in self.listpeers["peers"]:
             for channel_data in peer_data["channels"]:
                 if "short_channel_id" not in channel_data:
                     continue
                 channel_id = channel_data["short_channel_id"]
-                if channel_id not in self.channels:
+                if channel_id not in inputs:
                     print("unknown channel {} in listpeers".format(channel_id))
                     continue
-                channel = self.channels[channel_id]
-                channel.in_payments_offered = channel_data["in_payments_offered"]
-                channel.out_payments_offered = channel_data["out_payments_offered"]
-                channel.in_payments = channel_data["in_payments_fulfilled"]
-                channel.out_payments = channel_data["out_payments_fulfilled"]
-                channel.in_msatoshi_fulfilled = channel_data["in_msatoshi_fulfilled"]
-                channel.out_msatoshi_fulfilled = channel_data["out_msatoshi_fulfilled"]
-                channel.in_msatoshi_offered = channel_data["in_msatoshi_offered"]
-                channel.out_msatoshi_offered = channel_data["out_msatoshi_offered"]
-                channel_ref = self.get_channel_ref(channel_id)
-                if channel_ref is not None:
-                    # print(data_stored)
-                    # print("{} {} {} {}".format(channel.in_payments,
-                    #                           channel.out_payments,
-                    #                           channel_ref["in_payments"],
-                    #                           channel_ref["out_payments"]))
-                    channel.in_payments -= channel_ref["in_payments"]
-                    channel.out_payments -= channel_ref["out_payments"]
-                    channel.in_msatoshi_fulfilled -= channel_ref["in_msatoshi_fulfilled"]
-                    channel.out_msatoshi_fulfilled -= channel_ref["out_msatoshi_fulfilled"]
-                    if "in_msatoshi_offered" in channel_ref:
-                        channel.in_payments_offered -= channel_ref["in_payments_offered"]
-                        channel.out_payments_offered -= channel_ref["out_payments_offered"]
-                        channel.in_msatoshi_offered -= channel_ref["in_msatoshi_offered"]
-                        channel.out_msatoshi_offered -= channel_ref["out_msatoshi_offered"]
-                channel.total_payments_offered = (channel.in_payments_offered + channel.out_payments_offered)
-                channel.routed_amount = (channel.in_msatoshi_fulfilled + channel.out_msatoshi_fulfilled) / 1000
-                channel.routed_capacity = channel.routed_amount / channel.total_capacity
-                channel.total_payments = channel.in_payments + channel.out_payments
-                if channel.total_payments_offered != 0:
-                    channel.settle_rate = channel.total_payments / channel.total_payments_offered * 100
-                self.in_payments += channel.in_payments
-                self.out_payments += channel.out_payments
-                self.routed_amount += (channel.in_msatoshi_fulfilled + channel.out_msatoshi_fulfilled) / 2 / 1000
-        for (channel_id, channel) in self.channels.items():
-            channel_ref = self.get_channel_ref(channel_id)
-            if channel.new_channel:
-                channel.funding_block = self.block_height
-            else:
-                channel.funding_block = int(channel_id.split("x")[0])
-            channel.age = (self.block_height - channel.funding_block) * 600 / 86400
+                inputs[channel_id][6] = tuple(channel_data[name] for name in self.PEER_COUNTERS)
+        return {channel_id: tuple(channel_inputs) for (channel_id, channel_inputs) in inputs.items()}
+
+    PEER_COUNTERS = ("in_payments_offered", "out_payments_offered",
+                     "in_payments_fulfilled", "out_payments_fulfilled",
+                     "in_msatoshi_fulfilled", "out_msatoshi_fulfilled",
+                     "in_msatoshi_offered", "out_msatoshi_offered")
+
+    def add_channel(self, short_channel_id, inputs):
+        (peer_id, total, output, state, new_channel, gossip, counters) = inputs
+        channel = Channel(peer_id, short_channel_id, total - output, output, state, new_channel)
+        if gossip is not None:
+            (channel.last_update, channel.base_fee_msat, channel.ppm_fee) = gossip
+        if counters is not None:
+            (channel.in_payments_offered,
+             channel.out_payments_offered,
+             channel.in_payments,
+             channel.out_payments,
+             channel.in_msatoshi_fulfilled,
+             channel.out_msatoshi_fulfilled,
+             channel.in_msatoshi_offered,
+             channel.out_msatoshi_offered) = counters
+            self.counters[short_channel_id] = [getattr(channel, name) for name in HistoryStore.COUNTERS]
+            channel_ref = self.get_channel_ref(short_channel_id)
             if channel_ref is not None:
-                period = self.period
-            else:
-                period = channel.age
-            if period <= 0:
-                channel.tx_per_day = 0
-            else:
-                channel.tx_per_day = channel.total_payments / period
-            # if channel.output_capacity == 0:
-            #    channel.used_capacity = 1000
-            # else:
-            #    channel.used_capacity = channel.tx_per_day / channel.output_capacity * SATS_PER_BTC
-        # add aliases
-        self.listnodes = clapi.listnodes()["nodes"]
-        self.hashed_listnodes = {}
-        for node in self.listnodes:
-            if "alias" in node:
-                self.hashed_listnodes[node["nodeid"]] = node["alias"]
-        for (channel_id, channel) in self.channels.items():
-            if channel.peer_id in self.hashed_listnodes:
-                channel.alias = self.hashed_listnodes[channel.peer_id]
+                channel.in_payments -= channel_ref["in_payments"]
+                channel.out_payments -= channel_ref["out_payments"]
+                channel.in_msatoshi_fulfilled -= channel_ref["in_msatoshi_fulfilled"]
+                channel.out_msatoshi_fulfilled -= channel_ref["out_msatoshi_fulfilled"]
+                if "in_msatoshi_offered" in channel_ref:
+                    channel.in_payments_offered -= channel_ref["in_payments_offered"]
+                    channel.out_payments_offered -= channel_ref["out_payments_offered"]
+                    channel.in_msatoshi_offered -= channel_ref["in_msatoshi_offered"]
+                    channel.out_msatoshi_offered -= channel_ref["out_msatoshi_offered"]
+            channel.total_payments_offered = (channel.in_payments_offered + channel.out_payments_offered)
+            channel.routed_amount = (channel.in_msatoshi_fulfilled + channel.out_msatoshi_fulfilled) / 1000
+            channel.routed_capacity = channel.routed_amount / channel.total_capacity
+            channel.total_payments = channel.in_payments + channel.out_payments
+            if channel.total_payments_offered != 0:
+                channel.settle_rate = channel.total_payments / channel.total_payments_offered * 100
+        self.set_age(channel)
+        if self.loaded("hashed_listnodes") and peer_id in self.hashed_listnodes:
+            channel.alias = self.hashed_listnodes[peer_id]
+        self.channels[short_channel_id] = channel
+        self.add_totals(channel, 1)
+
+    def remove_channel(self, short_channel_id):
+        self.add_totals(self.channels.pop(short_channel_id), -1)
+        self.counters.pop(short_channel_id, None)
+
+    def add_totals(self, channel, sign):
+        self.channel_count += sign
+        self.input_capacity += sign * channel.input_capacity
+        self.output_capacity += sign * channel.output_capacity
+        self.in_payments += sign * channel.in_payments
+        self.out_payments += sign * channel.out_payments
+        self.routed_amount += sign * (channel.in_msatoshi_fulfilled + channel.out_msatoshi_fulfilled) / 2 / 1000
+
+    def set_age(self, channel):
+        if channel.new_channel:
+            channel.funding_block = self.block_height
+        else:
+            channel.funding_block = int(channel.short_id.split("x")[0])
+        channel.age = (self.block_height - channel.funding_block) * 600 / 86400
+        if self.get_channel_ref(channel.short_id) is not None:
+            period = self.period
+        else:
+            period = channel.age
+        if period <= 0:
+            channel.tx_per_day = 0
+        else:
+            channel.tx_per_day = channel.total_payments / period
+        # if channel.output_capacity == 0:
+        #    channel.used_capacity = 1000
+        # else:
+        #    channel.used_capacity = channel.tx_per_day / channel.output_capacity * SATS_PER_BTC
+
+    def rpc_result(self, name, pending):
+        # pending: a future of timed_call, or its result
+        (result, latency) = pending if isinstance(pending, tuple) else pending.result()
+        self.rpc_latency[name] = latency
+        return result
 
     def get_channel_ref(self, channel_id):
         if self.ref_data is not None and channel_id in self.ref_data:
@@ -483,100 +1612,266 @@ class Node:
         else:
             return None
 
-    def set_fees(self, force, k, offset, max_ppm):
-        DEFAULT_BASE_FEE = 0
-        for (channel_id, channel) in self.channels.items():
-            out_ratio = channel.output_capacity / (channel.input_capacity + channel.output_capacity)
-            if channel.ppm_fee == 0 and not force:
+    def fee_arrays(self, force):
+        # channel ids, out_ratio, ppm and base fees as arrays in channels order,
+        # and which channels get new fees: not the ones at 0 ppm unless forced,
+        # never the ones without capacity (their out_ratio is 0)
+        channels = list(self.channels.values())
+        output = np.array([channel.output_capacity for channel in channels], dtype=np.float64)
+        capacity = np.array([channel.input_capacity + channel.output_capacity for channel in channels],
+                            dtype=np.float64)
+        out_ratio = np.divide(output, capacity, out=np.zeros(len(channels)), where=capacity > 0)
+        ppm_fee = np.array([channel.ppm_fee for channel in channels], dtype=np.int64)
+        return (list(self.channels),
+                out_ratio,
+                ppm_fee,
+                np.array([channel.base_fee_msat for channel in channels], dtype=np.int64),
+                ((ppm_fee != 0) | force) & (capacity > 0))
+
+    def fee_plan(self, force, k, offset, max_ppm):
+        (channel_ids, out_ratio, ppm_fee, base_fee, eligible) = self.fee_arrays(force)
+        new_ppm_fee = fee_policy(out_ratio, k, offset, max_ppm)
+        changed = eligible & ((base_fee != DEFAULT_BASE_FEE) | (new_ppm_fee != ppm_fee))
+        skipped = [channel_ids[i] for i in np.flatnonzero(~eligible)]
+        plan = [munch.Munch(channel_id=channel_ids[i],
+                            out_ratio=float(out_ratio[i]),
+                            base_fee_msat=int(base_fee[i]),
+                            ppm_fee=int(ppm_fee[i]),
+                            new_base_fee_msat=DEFAULT_BASE_FEE,
+                            new_ppm_fee=int(new_ppm_fee[i]))
+                for i in np.flatnonzero(changed)]
+        return plan, skipped
+
+    def routed_per_day(self, channel_ids, days):
+        # outgoing msat and payments per day of each channel since the stored
+        # day closest to days ago, or over the channel lifetime without one
+        (ref_days, deltas) = self.window_deltas(channel_ids, [days])
+        if ref_days[0] is not None:
+            period = (NOW - timestamp_from_day(ref_days[0])) / DAY
+            if period >= 1:
+                deltas = np.nan_to_num(deltas[0])
+                return (deltas[:, 3] / period, deltas[:, 1] / period,
+                        "{:.1f} days of history since {}".format(period, ref_days[0]))
+        counters = np.array([self.counters.get(channel_id, [0] * len(HistoryStore.COUNTERS))
+                             for channel_id in channel_ids], dtype=np.float64).reshape(len(channel_ids), -1)
+        ages = np.array([max(self.channels[channel_id].age, 1) for channel_id in channel_ids])
+        return (counters[:, 3] / ages, counters[:, 1] / ages, "channel lifetimes, no stored history")
+
+    def fee_sweep(self, force, grid, days, limit):
+        # fees every policy of the grid would set, summarized per policy:
+        # channels changed, ppm quartiles and the fee income it would bring per
+        # day if each channel kept routing its recent outgoing volume
+        (channel_ids, out_ratio, ppm_fee, base_fee, eligible) = self.fee_arrays(force)
+        (volume, payments, volume_source) = self.routed_per_day(channel_ids, days)
+        (out_ratio, ppm_fee, base_fee) = (out_ratio[eligible], ppm_fee[eligible], base_fee[eligible])
+        (volume, payments) = (volume[eligible], payments[eligible])
+        grid = np.array(grid, dtype=np.int64).reshape(-1, 3)
+        start = time.perf_counter()
+        # income in sats per day: ppm * msat / 10^6 plus base msat per payment
+        current_income = ppm_fee @ volume / 1e9 + base_fee @ payments / 1e3
+        base_income = DEFAULT_BASE_FEE * payments.sum() / 1e3
+        base_changed = base_fee != DEFAULT_BASE_FEE
+        changed = np.zeros(len(grid), dtype=np.int64)
+        income = np.zeros(len(grid))
+        # with k >= 0 a fee never rises with out_ratio, so the fee quantiles
+        # are the fees of the out_ratio quantiles taken in reverse order
+        count = len(ppm_fee)
+        ranks = [int(q * (count - 1)) for q in (0, 0.25, 0.5, 0.75, 1)] if count else []
+        ratio_quantiles = np.sort(out_ratio)[[count - 1 - rank for rank in ranks]]
+        quartiles = fee_policy(ratio_quantiles, grid[:, 0], grid[:, 1], grid[:, 2])
+        # grid points in chunks of at most FEE_SWEEP_CELLS (point, channel) cells
+        step = max(1, FEE_SWEEP_CELLS // max(count, 1))
+        for first in range(0, len(grid), step):
+            points = grid[first:first + step]
+            new_ppm_fee = fee_policy(out_ratio, points[:, 0], points[:, 1], points[:, 2])
+            changed[first:first + len(points)] = ((new_ppm_fee != ppm_fee) | base_changed).sum(axis=1)
+            income[first:first + len(points)] = new_ppm_fee @ volume / 1e9 + base_income
+            negative = np.flatnonzero(points[:, 0] < 0)
+            if len(negative) and count:
+                quartiles[first + negative] = np.sort(new_ppm_fee[negative], axis=1)[:, ranks]
+        elapsed = time.perf_counter() - start
+        print("Fee sweep: {} policies over {} channels ({} skipped) in {:.3f}s".format(
+            len(grid), count, int((~eligible).sum()), elapsed))
+        print("Routed volume: {}, {:.0f} sats/day out, current fees {:.0f} sats/day".format(
+            volume_source, volume.sum() / 1000, current_income))
+        print("    k  offset     max  changed      min     25%  median     75%     max   fees/day    change")
+        order = np.argsort(-income, kind="stable")
+        for i in order[:limit]:
+            print("{:5d} {:7d} {:7d} {:8d}  {:7s} {:7s} {:7s} {:7s} {:7s} {:10.0f} {:+9.0f}".format(
+                grid[i, 0], grid[i, 1], grid[i, 2], changed[i],
+                *(["{:7d}".format(fee) for fee in quartiles[i]] if count else ["-"] * 5),
+                income[i], income[i] - current_income))
+
+    def apply_fee(self, change):
+        for attempt in range(1, SETFEES_RETRIES + 1):
+            try:
+                self.api.setchannelfee(change.channel_id, change.new_base_fee_msat, change.new_ppm_fee)
+                return None
+            except Exception as e:
+                if attempt == SETFEES_RETRIES:
+                    return str(e)
+                time.sleep(SETFEES_RETRY_DELAY * attempt)
+
+    def set_fees(self, force, k, offset, max_ppm, dry_run=False):
+        with TIMINGS.phase("setfees.plan"):
+            (plan, skipped) = self.fee_plan(force, k, offset, max_ppm)
+        if dry_run:
+            errors = [None] * len(plan)
+        else:
+            with TIMINGS.phase("setfees.apply"):
+                with concurrent.futures.ThreadPoolExecutor(max_workers=SETFEES_WORKERS) as executor:
+                    errors = list(executor.map(self.apply_fee, plan))
+        # one line per skipped or changed channel, in channels order
+        results = {change.channel_id: (change, error) for (change, error) in zip(plan, errors)}
+        skipped_ids = set(skipped)
+        failed = 0
+        for channel_id in self.channels:
+            if channel_id in skipped_ids:
                 print("{:13s} skipped".format(channel_id))
                 continue
-            elif out_ratio == 0:
-                new_ppm_fee = max_ppm
-            else:
-                new_ppm_fee = int(round(k / out_ratio + offset, -1))
-                if new_ppm_fee > max_ppm:
-                    new_ppm_fee = max_ppm
-            if channel.base_fee_msat == DEFAULT_BASE_FEE and new_ppm_fee == channel.ppm_fee:
+            if channel_id not in results:
                 continue
-            clapi.setchannelfee(channel_id, DEFAULT_BASE_FEE, new_ppm_fee)
-            print("{:13s} {:4.0f}%  {:5d}/{:5d} -> {:5d}/{:5d}".format(channel_id,
-                                                                       out_ratio * 100,
-                                                                       channel.base_fee_msat,
-                                                                       channel.ppm_fee,
-                                                                       DEFAULT_BASE_FEE,
-                                                                       new_ppm_fee))
-
-    def print_channel(self, channel, verbosity):
-        # "- {short_id:13s}  {peer_info}  {cap_info}  {payments_info}  {age_info}  {tx_per_day:5.1f}  {routed_capacity:6.2f}  {state} ({base_fee_msat}/{ppm_fee})"
-        payments_str = "{:8s} {:4d}".format(
-            "{:4d}-{:<d}".format(
-                channel.in_payments,
-                channel.out_payments),
-            channel.total_payments,
-        )
-        settle_rate_str = "{:5.1f}%".format(channel.settle_rate) if channel.settle_rate is not None else "  n/a "
-        print("- {:13s}  {}  {}  {}  {}  {:5.1f}  {:6.2f}  {}  {} ({}/{})".format(
-            channel.short_id,
-            peer_id_string(channel.alias, channel.peer_id, verbosity),
-            capacity_string(channel.input_capacity, channel.output_capacity, verbosity),
-            payments_str,
-            age_string2(channel.age),
-            channel.tx_per_day,
-            channel.routed_capacity,
-            # age_string(channel.last_update),
-            settle_rate_str,
-            channel.state,
-            channel.base_fee_msat,
-            channel.ppm_fee
-        ))
-
-    def print_status(self, verbosity=2, sort_key=None, limit=0, filters=None):
+            (change, error) = results[channel_id]
+            line = "{:13s} {:4.0f}%  {:5d}/{:5d} -> {:5d}/{:5d}".format(change.channel_id,
+                                                                        change.out_ratio * 100,
+                                                                        change.base_fee_msat,
+                                                                        change.ppm_fee,
+                                                                        change.new_base_fee_msat,
+                                                                        change.new_ppm_fee)
+            if error is not None:
+                failed += 1
+                line += "  FAILED: {}".format(error)
+            print(line)
+        if dry_run:
+            print("dry run: {} channels to update, {} skipped".format(len(plan), len(skipped)))
+        else:
+            print("{} channels updated, {} failed, {} skipped".format(len(plan) - failed, failed, len(skipped)))
+
+    def window_deltas(self, channel_ids, windows):
+        # reference day of each window and the counter deltas since then,
+        # shaped (windows, channels, counters): one difference between the
+        # current counters and the stored snapshot closest to each window
+        ref_days = [self.history.nearest_day(day(window)) for window in windows]
+        stored = sorted(set(ref_day for ref_day in ref_days if ref_day is not None))
+        if not stored:
+            return (ref_days, None)
+        current = np.array([self.counters.get(channel_id, [0] * len(HistoryStore.COUNTERS))
+                            for channel_id in channel_ids], dtype=np.float64).reshape(len(channel_ids), -1)
+        refs = self.history.counter_arrays(channel_ids, stored)
+        ref_index = [stored.index(ref_day) if ref_day is not None else 0 for ref_day in ref_days]
+        return (ref_days, current[np.newaxis] - refs[ref_index])
+
+    def window_lines(self, items, windows):
+        (ref_days, deltas) = self.window_deltas([channel_id for (channel_id, channel) in items], windows)
+        if deltas is None:
+            return ["Windows: no history stored\n"]
+        (payments, amount, settle_rate) = counter_stats(deltas)
+        lines = ["Windows:" + " " * 25 + "".join("  {:>25s}".format(
+            "{}d (ref {})".format(window, ref_day) if ref_day is not None else "{}d (no ref)".format(window))
+            for (window, ref_day) in zip(windows, ref_days)) + "\n"]
+        rows = [("- {:13s}  {:16.16s}".format(channel.short_id, filter_alias(channel.alias)),
+                 [(payments[w, i], amount[w, i], settle_rate[w, i]) for w in range(len(windows))])
+                for (i, (channel_id, channel)) in enumerate(items)]
+        (payments, amount, settle_rate) = counter_stats(deltas.sum(axis=1))
+        rows += [("- {:13s}  {:16.16s}".format("TOTAL", ""),
+                  [(payments[w], amount[w], settle_rate[w]) for w in range(len(windows))])]
+        for (label, stats) in rows:
+            lines += [label + "".join("  {}".format(stats_string(*stats)) if ref_day is not None
+                                      else "  {:>25s}".format("-")
+                                      for (stats, ref_day) in zip(stats, ref_days)) + "\n"]
+        return lines
+
+    def print_series(self):
+        # routed payments and amount between consecutive stored days, and
+        # from the last one until now, over every channel ever stored
+        (days, channel_ids, counters, present) = self.history.history()
+        if not days:
+            print("Series: no history stored")
+            return
+        current = np.full((1,) + counters.shape[1:], np.nan)
+        now_present = np.zeros((1, len(channel_ids)), dtype=bool)
+        for (j, channel_id) in enumerate(channel_ids):
+            if channel_id in self.counters:
+                current[0, j] = self.counters[channel_id]
+                now_present[0, j] = True
+        counters = np.concatenate([counters, current])
+        present = np.concatenate([present, now_present])
+        # a channel missing from the earlier day was opened since (counts
+        # from 0), one missing from the later day was closed (no delta)
+        earlier = np.where(present[:-1, :, np.newaxis], counters[:-1], 0)
+        deltas = np.where(present[1:, :, np.newaxis], counters[1:] - earlier, 0)
+        (payments, amount, settle_rate) = counter_stats(deltas.sum(axis=1))
+        print("Series:")
+        for (i, start) in enumerate(days):
+            end = days[i + 1] if i + 1 < len(days) else "now"
+            print("- {} -> {:8s}  {}".format(start, end, stats_string(payments[i], amount[i], settle_rate[i])))
+        print()
+
+    def print_status(self, verbosity=2, sort_key=None, limit=0, filters=None, windows=None, output_format="table"):
         if not filters:
             if verbosity <= 2:
                 filters = ["-any", "total_payments>0", "age<1", "state<>CHANNELD_NORMAL"]
             else:
                 filters = []
         pipe = FilterPipe()
-        for filter in filters:
-            pipe.add_filter(filter)
-        print("Wallet funds (BTC):")
-        print("- Confirmed:   {:11.8f}".format(self.wallet_value_confirmed / SATS_PER_BTC))
-        print("- Unconfirmed: {:11.8f}".format(self.wallet_value_unconfirmed / SATS_PER_BTC))
-        print("- TOTAL:       {:11.8f}".format(self.total_wallet / SATS_PER_BTC))
-        for channel_id in self.ignored_channels:
-            if channel_id in self.channels:
-                del self.channels[channel_id]
-        print("Channels: " + ("(ref: {} days ago)".format(self.since) if self.since is not None else ""))
-        items = list(self.channels.items())
+        try:
+            with TIMINGS.phase("status.filter"):
+                for filter in filters:
+                    pipe.add_filter(filter)
+                predicate = pipe.compile(set(Channel.__slots__))
+        except FilterError as e:
+            print(e)
+            exit(1)
+        items = (item for item in self.channels.items()
+                 if item[0] not in self.ignored_channels and predicate(item[1]))
         if sort_key is not None:
-            if sort_key.startswith("/"):
-                reverse = True
-                sort_key = sort_key[1:]
-            else:
-                reverse = False
-            items.sort(key=lambda item: item[1][sort_key], reverse=reverse)
-        count = 0
-        for (channel_id, channel) in items:
-            if limit > 0:
-                if count >= limit:
-                    break
-            if not pipe.exec(channel):
-                continue
-            count += 1
-            self.print_channel(channel, verbosity)
-        print("Node summary:")
-        print("- # of channels   : {}".format(self.channel_count))
-        print("- Capacity        : {:.8f} ({:.8f} + {:.8f})".format(
-            self.total / SATS_PER_BTC,
-            self.input_capacity / SATS_PER_BTC,
-            self.output_capacity / SATS_PER_BTC))
-        print("- Routed payments : {}".format(self.in_payments))
-        print("- Routed amount   : {:.8f} BTC".format(self.routed_amount / SATS_PER_BTC))
+            reverse = sort_key.startswith("/")
+            sort_key = sort_key.lstrip("/")
+            if sort_key not in Channel.__slots__:
+                print("unknown sort key: " + sort_key)
+                exit(1)
+            field = operator.attrgetter(sort_key)
+            key = lambda item: field(item[1])
+            # same order as a stable sort, only the first limit channels are kept in order
+            with TIMINGS.phase("status.select"):
+                if limit > 0:
+                    items = (heapq.nlargest if reverse else heapq.nsmallest)(limit, items, key=key)
+                else:
+                    items = sorted(items, key=key, reverse=reverse)
+        else:
+            with TIMINGS.phase("status.select"):
+                items = list(itertools.islice(items, limit) if limit > 0 else items)
+        if output_format != "table":
+            with TIMINGS.phase("status.print"):
+                self.write_records(items, output_format)
+            return
+        # the report is built as a list of lines and written at once
+        lines = ["Wallet funds (BTC):\n",
+                 "- Confirmed:   {:11.8f}\n".format(self.wallet_value_confirmed / SATS_PER_BTC),
+                 "- Unconfirmed: {:11.8f}\n".format(self.wallet_value_unconfirmed / SATS_PER_BTC),
+                 "- TOTAL:       {:11.8f}\n".format(self.total_wallet / SATS_PER_BTC),
+                 "Channels: " + ("(ref: {} days ago)".format(self.since) if self.since is not None else "") + "\n"]
+        with TIMINGS.phase("status.print"):
+            rows = ChannelRows(verbosity)
+            lines += [rows.row(channel) for (channel_id, channel) in items]
+        if windows:
+            with TIMINGS.phase("status.windows"):
+                lines += self.window_lines(items, windows)
         routed_capacity = self.routed_amount / self.total * 2
-        print("- Routed capacity : {:.2f}".format(routed_capacity))
         tvl = self.output_capacity + self.total_wallet
-        print("- Node Value      : {:.8f} BTC".format(tvl / SATS_PER_BTC))
-        print("- Fees collected  : {:.0f} sats".format(self.fees_collected))
+        lines += ["Node summary:\n",
+                  "- # of channels   : {}\n".format(self.channel_count),
+                  "- Capacity        : {:.8f} ({:.8f} + {:.8f})\n".format(self.total / SATS_PER_BTC,
+                                                                          self.input_capacity / SATS_PER_BTC,
+                                                                          self.output_capacity / SATS_PER_BTC),
+                  "- Routed payments : {}\n".format(self.in_payments),
+                  "- Routed amount   : {:.8f} BTC\n".format(self.routed_amount / SATS_PER_BTC),
+                  "- Routed capacity : {:.2f}\n".format(routed_capacity),
+                  "- Node Value      : {:.8f} BTC\n".format(tvl / SATS_PER_BTC),
+                  "- Fees collected  : {:.0f} sats\n".format(self.fees_collected)]
+        if verbosity >= 5:
+            lines += ["- RPC latency     : {}\n".format(", ".join(
+                "{} {:.3f}s".format(name, latency) for (name, latency) in self.rpc_latency.items()))]
         # self.all_last_updates.sort()
         # if len(self.all_last_updates) > 0:
         #     median_index = len(self.all_last_updates) // 2
@@ -585,23 +1880,1078 @@ class Node:
         #     else:
         #         median_value = self.all_last_updates[median_index]
         #     print("Median last update : {:4.1f} days".format((NOW - median_value) / DAY))
-        print()
+        lines += ["\n"]
+        sys.stdout.write("".join(lines))
+
+    def write_records(self, items, output_format):
+        # the listed channels as records of every Channel field, written as
+        # they are produced. json wraps them with the wallet and node totals.
+        values = operator.attrgetter(*Channel.__slots__)
+        out = sys.stdout
+        if output_format == "csv":
+            writer = csv.writer(out, lineterminator="\n")
+            writer.writerow(Channel.__slots__)
+            for (channel_id, channel) in items:
+                writer.writerow(values(channel))
+        elif output_format == "ndjson":
+            for (channel_id, channel) in items:
+                out.write(json.dumps(dict(zip(Channel.__slots__, values(channel)))) + "\n")
+        else:
+            wallet = {"confirmed": self.wallet_value_confirmed,
+                      "unconfirmed": self.wallet_value_unconfirmed,
+                      "total": self.total_wallet}
+            out.write('{{"wallet": {}, "since": {}, "channels": ['.format(json.dumps(wallet), json.dumps(self.since)))
+            separator = "\n"
+            for (channel_id, channel) in items:
+                out.write(separator + json.dumps(dict(zip(Channel.__slots__, values(channel)))))
+                separator = ",\n"
+            out.write('\n], "summary": {}}}\n'.format(json.dumps(self.summary())))
+
+    def summary(self):
+        return {"channel_count": self.channel_count,
+                "total_capacity": self.total,
+                "input_capacity": self.input_capacity,
+                "output_capacity": self.output_capacity,
+                "routed_payments": self.in_payments,
+                "routed_amount": self.routed_amount,
+                "routed_capacity": self.routed_amount / self.total * 2 if self.total else 0,
+                "node_value": self.output_capacity + self.total_wallet,
+                "fees_collected": self.fees_collected}
 
     def store_today_data(self):
-        stored_data = file_content(LCW_DATA_PATH)
-        if stored_data is None:
-            stored_json = {}
+        counters = {channel_id: {name: getattr(channel, name) for name in HistoryStore.COUNTERS}
+                    for (channel_id, channel) in self.channels.items()}
+        with TIMINGS.phase("store.write"):
+            return self.history.store(day(), counters)
+
+
+class ChannelGraph:
+    # Compact view of the gossip graph: pubkeys are interned to integer ids and
+    # the adjacency is kept in CSR arrays. Parallel channels between the same
+    # two nodes are merged into one edge whose capacity is their sum. Only
+    # nodes that are the source of at least one channel take part in the
+    # traversals, as destinations without channels are never walked through.
+    MAX_DEPTH = 9
+    BATCH_WORDS = 4
+
+    def __init__(self, node_ids, channel_source, channel_destination, channel_satoshis):
+        self.node_ids = node_ids
+        self.index = {node_id: i for (i, node_id) in enumerate(node_ids)}
+        self.node_count = len(node_ids)
+        self.channel_source = channel_source
+        self.channel_destination = channel_destination
+        self.channel_satoshis = channel_satoshis
+        self.channel_count = np.bincount(channel_source, minlength=self.node_count)
+        keep = self.channel_count[channel_destination] > 0
+        keys = channel_source[keep].astype(np.int64) * self.node_count + channel_destination[keep]
+        (edge_keys, inverse) = np.unique(keys, return_inverse=True)
+        self.capacity = np.zeros(len(edge_keys), dtype=np.int64)
+        np.add.at(self.capacity, inverse, channel_satoshis[keep])
+        self.edge_source = (edge_keys // self.node_count).astype(np.int32)
+        self.indices = (edge_keys % self.node_count).astype(np.int32)
+        self.indptr = np.zeros(self.node_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.edge_source, minlength=self.node_count), out=self.indptr[1:])
+        self.in_order = None
+        self.in_indptr = None
+
+    @classmethod
+    def from_channels(cls, channels):
+        index = {}
+        node_ids = []
+        sources = []
+        destinations = []
+        satoshis = []
+        for channel in channels:
+            for (pubkey, ids) in ((channel["source"], sources), (channel["destination"], destinations)):
+                node = index.get(pubkey)
+                if node is None:
+                    node = len(node_ids)
+                    index[pubkey] = node
+                    node_ids += [pubkey]
+                ids.append(node)
+            satoshis.append(channel["satoshis"])
+        return cls(node_ids,
+                   np.array(sources, dtype=np.int32),
+                   np.array(destinations, dtype=np.int32),
+                   np.array(satoshis, dtype=np.int64))
+
+    def source_order(self):
+        # nodes with channels, in the order they first appear as a source
+        (sources, first) = np.unique(self.channel_source, return_index=True)
+        return sources[np.argsort(first, kind="stable")]
+
+    def channels_of(self, node):
+        return np.flatnonzero(self.channel_source == node)
+
+    def start_edges(self, node, new_peer=None, without_index=None):
+        if new_peer is None and without_index is None:
+            start, end = self.indptr[node], self.indptr[node + 1]
+            return self.indices[start:end], self.capacity[start:end]
+        channels = self.channels_of(node)
+        destinations = self.channel_destination[channels]
+        satoshis = self.channel_satoshis[channels]
+        if new_peer is not None:
+            destinations = np.append(destinations, new_peer[0])
+            satoshis = np.append(satoshis, new_peer[1])
+        elif without_index is not None:
+            destinations = np.delete(destinations, without_index)
+            satoshis = np.delete(satoshis, without_index)
+        keep = self.channel_count[destinations] > 0
+        (destinations, inverse) = np.unique(destinations[keep], return_inverse=True)
+        capacity = np.zeros(len(destinations), dtype=np.int64)
+        np.add.at(capacity, inverse, satoshis[keep])
+        return destinations, capacity
+
+    def bfs(self, node, new_peer=None, without_index=None):
+        # level of every node (-1 when not reached within MAX_DEPTH hops) and,
+        # for each level, the capacity of the edges entering it from the
+        # previous level
+        levels = np.full(self.node_count, -1, dtype=np.int8)
+        levels[node] = 0
+        visited = np.zeros(self.node_count, dtype=bool)
+        visited[node] = True
+        (destinations, capacity) = self.start_edges(node, new_peer, without_index)
+        hop_sums = []
+        for depth in range(1, self.MAX_DEPTH + 1):
+            new = ~visited[destinations]
+            if not new.any():
+                break
+            frontier = np.zeros(self.node_count, dtype=bool)
+            frontier[destinations[new]] = True
+            hop_sums += [int(capacity[new].sum())]
+            levels[frontier] = depth
+            visited |= frontier
+            active = frontier[self.edge_source]
+            destinations = self.indices[active]
+            capacity = self.capacity[active]
+        return levels, hop_sums
+
+    def in_edges(self):
+        # edge positions grouped by destination, built on first use
+        if self.in_order is None:
+            self.in_order = np.argsort(self.indices, kind="stable")
+            self.in_indptr = np.zeros(self.node_count + 1, dtype=np.int64)
+            np.cumsum(np.bincount(self.indices, minlength=self.node_count), out=self.in_indptr[1:])
+        return self.in_order, self.in_indptr
+
+    def base_levels(self, node):
+        (levels, base_hops) = self.bfs(node)
+        base = levels.astype(np.int16)
+        base[base < 0] = self.MAX_DEPTH + 1
+        tree = (base[self.indices] == base[self.edge_source] + 1) & (base[self.indices] <= self.MAX_DEPTH)
+        base_count = np.bincount(base, minlength=self.MAX_DEPTH + 2)
+        return base, tree, base_hops, base_count
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        # traversal-only graph (no pubkeys, no raw channels), as used by the
+        # worker processes of a GraphPool
+        graph = cls.__new__(cls)
+        graph.__dict__.update(arrays)
+        graph.node_count = len(graph.indptr) - 1
+        graph.in_order = None
+        graph.in_indptr = None
+        return graph
+
+    def save(self, path):
+        # binary snapshot: a JSON header with the array layout, then the
+        # arrays themselves so that load() can memory-map them
+        keys = [bytes.fromhex(node_id) for node_id in self.node_ids]
+        if any(len(key) != 33 for key in keys):
+            print("unexpected node id length, network snapshot not saved")
+            return
+        node_keys = np.frombuffer(b"".join(keys), dtype=np.uint8).reshape(-1, 33)
+        arrays = dict(self.shared_arrays(),
+                      node_keys=node_keys,
+                      key_order=np.array(sorted(range(len(keys)), key=keys.__getitem__), dtype=np.int32),
+                      channel_source=self.channel_source,
+                      channel_destination=self.channel_destination,
+                      channel_satoshis=self.channel_satoshis)
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as file:
+            file.write(bytes(GRAPH_SNAPSHOT_HEADER))
+        layout = write_arrays(temp_path, arrays, offset=GRAPH_SNAPSHOT_HEADER)
+        header = json.dumps({"version": GRAPH_SNAPSHOT_VERSION, "created": NOW, "layout": layout}).encode()
+        with open(temp_path, "r+b") as file:
+            file.write(GRAPH_SNAPSHOT_MAGIC + len(header).to_bytes(4, "little") + header)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path, "rb") as file:
+                head = file.read(GRAPH_SNAPSHOT_HEADER)
+        except OSError:
+            return None
+        if not head.startswith(GRAPH_SNAPSHOT_MAGIC):
+            return None
+        size = int.from_bytes(head[len(GRAPH_SNAPSHOT_MAGIC):len(GRAPH_SNAPSHOT_MAGIC) + 4], "little")
+        header = json.loads(head[len(GRAPH_SNAPSHOT_MAGIC) + 4:len(GRAPH_SNAPSHOT_MAGIC) + 4 + size])
+        if header["version"] != GRAPH_SNAPSHOT_VERSION:
+            return None
+        arrays = map_arrays(path, header["layout"])
+        graph = cls.from_arrays(arrays)
+        graph.node_ids = PubkeyTable(graph.node_keys, graph.key_order)
+        graph.index = PubkeyIndex(graph.node_ids)
+        graph.created = header["created"]
+        return graph
+
+    def shared_arrays(self):
+        return {"indptr": self.indptr,
+                "indices": self.indices,
+                "capacity": self.capacity,
+                "edge_source": self.edge_source,
+                "channel_count": self.channel_count}
+
+    def batches(self, items, pool=None):
+        batch_size = 64 * self.BATCH_WORDS
+        if pool is not None:
+            # enough batches to keep every worker busy
+            per_job = -(-len(items) // pool.jobs)
+            batch_size = max(64, min(batch_size, -(-per_job // 64) * 64))
+        return [items[offset:offset + batch_size] for offset in range(0, len(items), batch_size)]
+
+    def run_batches(self, method, batches, args, pool=None):
+        if pool is None:
+            results = [getattr(self, method)(batch, *args) for batch in batches]
         else:
-            stored_json = stored_data
-        today = day()
-        history = stored_json["history"]
-        if today in history:
-            print("today's data is already stored")
+            results = pool.map(method, batches, args)
+        return [hop_sums for batch in results for hop_sums in batch]
+
+    def multi_source_hops(self, sources, pool=None):
+        # hop sums of a plain BFS from each source, one bit per source
+        return self.run_batches("source_batch", self.batches(sources, pool), (), pool)
+
+    def source_batch(self, sources):
+        words = (len(sources) + 63) // 64
+        source, destination = self.edge_source, self.indices
+        frontier = np.zeros((self.node_count, words), dtype=np.uint64)
+        for (bit, node) in enumerate(sources):
+            frontier[node, bit // 64] |= np.uint64(1 << (bit % 64))
+        visited = frontier.copy()
+        sums = []
+        counts = []
+        for depth in range(1, self.MAX_DEPTH + 1):
+            edges = np.flatnonzero(frontier.any(axis=1)[source])
+            if len(edges) == 0:
+                break
+            edges = edges[np.argsort(destination[edges], kind="stable")]
+            targets = destination[edges]
+            firsts = np.flatnonzero(np.r_[True, targets[1:] != targets[:-1]])
+            reached = np.bitwise_or.reduceat(frontier[source[edges]], firsts, axis=0) & ~visited[targets[firsts]]
+            previous = frontier
+            frontier = np.zeros_like(visited)
+            frontier[targets[firsts]] = reached
+            entering = previous[source[edges]] & frontier[targets]
+            kept = entering.any(axis=1)
+            sums += [bit_sums(entering[kept], self.capacity[edges[kept]])]
+            counts += [bit_sums(reached)]
+            visited |= frontier
+        results = []
+        for bit in range(len(sources)):
+            hop_sums = []
+            for (hop_sum, count) in zip(sums, counts):
+                if count[bit] == 0:
+                    break
+                hop_sums += [int(hop_sum[bit])]
+            results += [hop_sums]
+        return results
+
+    def contribution_hops(self, node):
+        # hop sums from node without each of its channels, in channels_of
+        # order. One BFS records, for every node, the set of first-hop peers
+        # giving it a shortest path. Dropping the last channel to a peer only
+        # moves the nodes whose set is that peer alone; those sets are
+        # disjoint, so re-levelling all of them touches each edge about once.
+        (base, tree, base_hops, base_count) = self.base_levels(node)
+        source, destination = self.edge_source, self.indices
+        (peers, peer_capacity) = self.start_edges(node)
+        # a channel to itself reaches nobody and owns no first hop
+        peers = peers[peers != node]
+        words = max((len(peers) + 63) // 64, 1)
+        first_hops = np.zeros((self.node_count, words), dtype=np.uint64)
+        for (bit, peer) in enumerate(peers):
+            first_hops[peer, bit // 64] |= np.uint64(1 << (bit % 64))
+        for depth in range(2, self.MAX_DEPTH + 1):
+            edges = np.flatnonzero(tree & (base[destination] == depth))
+            if len(edges) == 0:
+                break
+            edges = edges[np.argsort(destination[edges], kind="stable")]
+            targets = destination[edges]
+            firsts = np.flatnonzero(np.r_[True, targets[1:] != targets[:-1]])
+            first_hops[targets[firsts]] = np.bitwise_or.reduceat(first_hops[source[edges]], firsts, axis=0)
+        bits = np.unpackbits(first_hops.astype("<u8").view(np.uint8), axis=1, bitorder="little")
+        single = np.flatnonzero(bits.sum(axis=1) == 1)
+        owner = bits[single].argmax(axis=1)
+        order = np.argsort(owner, kind="stable")
+        bounds = np.searchsorted(owner[order], np.arange(len(peers) + 1))
+        removed = {}
+        results = []
+        channels = self.channels_of(node)
+        destinations = self.channel_destination[channels]
+        for (channel, peer) in zip(channels, destinations):
+            if self.channel_count[peer] == 0 or peer == node:
+                results += [list(base_hops)]
+            elif (destinations == peer).sum() > 1:
+                hop_sums = list(base_hops)
+                if hop_sums:
+                    hop_sums[0] -= int(self.channel_satoshis[channel])
+                results += [hop_sums]
+            else:
+                if peer not in removed:
+                    bit = np.searchsorted(peers, peer)
+                    affected = single[order[bounds[bit]:bounds[bit + 1]]]
+                    removed[peer] = self.removal_hops(node, affected, base, tree, base_hops, base_count)
+                results += [list(removed[peer])]
+        return results
+
+    def removal_hops(self, node, affected, base, tree, base_hops, base_count):
+        # hop sums from node once the affected nodes lose their only
+        # first-hop peer: re-level them from their other predecessors
+        source, destination = self.edge_source, self.indices
+        (in_order, in_indptr) = self.in_edges()
+        unreached = self.MAX_DEPTH + 1
+        inside = np.zeros(self.node_count, dtype=bool)
+        inside[affected] = True
+        levels = base.copy()
+        levels[affected] = unreached
+        entering = in_order[csr_ranges(in_indptr, affected)]
+        outside = entering[~inside[source[entering]] & (source[entering] != node)]
+        np.minimum.at(levels, destination[outside], np.minimum(base[source[outside]] + 1, unreached))
+        for depth in range(1, self.MAX_DEPTH):
+            frontier = affected[levels[affected] == depth]
+            targets = destination[csr_ranges(self.indptr, frontier)]
+            np.minimum.at(levels, targets[inside[targets]], depth + 1)
+        changed = np.unique(np.concatenate([csr_ranges(self.indptr, affected), entering]))
+        (changed_source, changed_destination) = (source[changed], destination[changed])
+        capacity = self.capacity[changed]
+        hop_sums = np.zeros(unreached + 1, dtype=np.int64)
+        hop_sums[1:len(base_hops) + 1] = base_hops
+        was = tree[changed]
+        np.subtract.at(hop_sums, base[changed_destination[was]], capacity[was])
+        now = ((levels[changed_destination] == levels[changed_source] + 1) &
+               (levels[changed_destination] <= self.MAX_DEPTH) & (changed_source != node))
+        np.add.at(hop_sums, levels[changed_destination[now]], capacity[now])
+        counts = base_count.copy()
+        np.subtract.at(counts, base[affected], 1)
+        np.add.at(counts, levels[affected], 1)
+        result = []
+        for depth in range(1, self.MAX_DEPTH + 1):
+            if counts[depth] == 0:
+                break
+            result += [int(hop_sums[depth])]
+        return result
+
+    def hyperanf(self, registers):
+        # approximate number of nodes first reached at each hop from every
+        # node, HyperANF style: each node holds a HyperLogLog counter of the
+        # nodes within t hops and one pass over the edges per hop merges the
+        # counters of its neighbours into it
+        index_bits = registers.bit_length() - 1
+        hashes = np.arange(self.node_count, dtype=np.uint64) + np.uint64(0x9e3779b97f4a7c15)
+        hashes = (hashes ^ (hashes >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        hashes = (hashes ^ (hashes >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+        hashes ^= hashes >> np.uint64(31)
+        register = (hashes & np.uint64(registers - 1)).astype(np.int64)
+        rest = hashes >> np.uint64(index_bits)
+        bit_length = np.zeros(self.node_count, dtype=np.int64)
+        for shift in (32, 16, 8, 4, 2, 1):
+            high = rest >= (np.uint64(1) << np.uint64(shift))
+            rest[high] >>= np.uint64(shift)
+            bit_length[high] += shift
+        bit_length += rest > 0
+        counters = np.zeros((self.node_count, registers), dtype=np.uint8)
+        nodes = np.flatnonzero(self.channel_count > 0)
+        counters[nodes, register[nodes]] = 64 - index_bits - bit_length[nodes] + 1
+        sources = np.flatnonzero(np.diff(self.indptr) > 0)
+        reach = np.zeros((self.node_count, self.MAX_DEPTH))
+        previous = hll_estimate(counters)
+        active = np.ones(self.node_count, dtype=bool)
+        for depth in range(self.MAX_DEPTH):
+            merged = np.maximum.reduceat(counters[self.indices], self.indptr[sources], axis=0)
+            updated = counters.copy()
+            updated[sources] = np.maximum(counters[sources], merged)
+            active &= (updated != counters).any(axis=1)
+            if not active.any():
+                break
+            estimate = hll_estimate(updated)
+            reach[active, depth] = np.maximum(estimate - previous, 0)[active]
+            (counters, previous) = (updated, estimate)
+        return reach
+
+    def candidate_hops(self, node, candidates, amount, pool=None):
+        # hop sums seen from node after opening a channel of amount sats to
+        # each candidate. The baseline BFS runs once; a new channel only moves
+        # the nodes where 1 + dist(candidate, v) < dist(node, v), so each batch
+        # of candidates walks those nodes only, one bit per candidate, and
+        # re-counts the edges touching them.
+        args = (node, amount) + self.base_levels(node)
+        return self.run_batches("candidate_batch", self.batches(candidates, pool), args, pool)
+
+    def candidate_bounds(self, node, candidates, amount, base, tree):
+        # upper bound of the centrality_score fraction after a channel to each
+        # candidate, from its peers and their peers only. Nodes at level <= 3
+        # keep their level and incoming capacity unless the candidate pulls
+        # them closer: it lands at level 1, its peers at level <= 2 and their
+        # peers at level <= 3, each fed by at most the capacity from the level
+        # above. Every other node ends at level 4 or deeper. The bound is the
+        # best fraction those limits allow.
+        incoming = np.bincount(self.indices, weights=self.capacity, minlength=self.node_count)
+        kept = np.bincount(self.indices[tree], weights=self.capacity[tree], minlength=self.node_count)
+        near = (base >= 1) & (base <= 3)
+        near_weight = (kept / np.maximum(base, 1))[near].sum()
+        near_total = kept[near].sum()
+        far_total = incoming[base >= 4].sum()
+        (peers, peer_capacity) = self.start_edges(node)
+        bounds = np.zeros(len(candidates))
+        for (i, candidate) in enumerate(candidates):
+            start, end = self.indptr[candidate], self.indptr[candidate + 1]
+            first = self.indices[start:end]
+            first_capacity = self.capacity[start:end]
+            second_edges = csr_ranges(self.indptr, first)
+            second = self.indices[second_edges]
+            from_first = np.bincount(second, weights=self.capacity[second_edges], minlength=self.node_count)
+            masses = np.zeros(5)
+            position = np.searchsorted(peers, candidate)
+            masses[1] = amount + (peer_capacity[position] if position < len(peers) and peers[position] == candidate else 0)
+            moved = [candidate] if 1 <= base[candidate] <= 3 else []
+            # the candidate's peers: level 2 unless already at level 1
+            keep = (first != node) & (first != candidate) & (base[first] >= 2)
+            (first, first_capacity) = (first[keep], first_capacity[keep])
+            masses[2] += first_capacity.sum() + kept[first[base[first] == 2]].sum()
+            moved += list(first[base[first] <= 3])
+            # their peers: level 3 unless already at level 1 or 2
+            in_first = np.zeros(self.node_count, dtype=bool)
+            in_first[first] = True
+            in_first[candidate] = True
+            in_first[node] = True
+            second = np.unique(second)
+            second = second[~in_first[second] & (base[second] >= 3)]
+            masses[3] += from_first[second].sum() + kept[second[base[second] == 3]].sum()
+            moved += list(second[base[second] == 3])
+            moved = np.array(moved, dtype=np.int64)
+            weight = near_weight - (kept[moved] / base[moved]).sum()
+            total = near_total - kept[moved].sum()
+            masses[4] = far_total - incoming[first[base[first] >= 4]].sum() - incoming[second[base[second] >= 4]].sum()
+            if base[candidate] >= 4:
+                masses[4] -= incoming[candidate]
+            for depth in range(1, 5):
+                if masses[depth] > 0 and (total == 0 or 1 / depth > weight / total):
+                    weight += masses[depth] / depth
+                    total += masses[depth]
+            bounds[i] = weight / total if total > 0 else 0
+        return bounds
+
+    def candidate_batch(self, candidates, node, amount, base, tree, base_hops, base_count):
+        words = (len(candidates) + 63) // 64
+        source, destination = self.edge_source, self.indices
+        frontier = np.zeros((self.node_count, words), dtype=np.uint64)
+        extra = np.zeros(words * 64, dtype=np.int64)
+        for (bit, candidate) in enumerate(candidates):
+            if candidate == node or self.channel_count[candidate] == 0:
+                continue
+            extra[bit] = amount
+            if base[candidate] > 1:
+                frontier[candidate, bit // 64] |= np.uint64(1 << (bit % 64))
+        improved = frontier.copy()
+        frontiers = [np.zeros_like(frontier), frontier]
+        for depth in range(2, self.MAX_DEPTH + 1):
+            previous = frontier
+            frontier = np.zeros_like(improved)
+            frontiers += [frontier]
+            edges = np.flatnonzero(previous.any(axis=1)[source])
+            edges = edges[base[destination[edges]] > depth]
+            if len(edges) == 0:
+                continue
+            order = np.argsort(destination[edges], kind="stable")
+            edges = edges[order]
+            targets = destination[edges]
+            firsts = np.flatnonzero(np.r_[True, targets[1:] != targets[:-1]])
+            reached = np.bitwise_or.reduceat(previous[source[edges]], firsts, axis=0)
+            targets = targets[firsts]
+            frontier[targets] = reached & ~improved[targets]
+            improved |= frontier
+        at_level = []
+        for depth in range(self.MAX_DEPTH + 1):
+            mask = frontiers[depth].copy()
+            rows = base == depth
+            mask[rows] |= ~improved[rows]
+            at_level += [mask]
+        changed_bits = improved[source] | improved[destination]
+        changed = np.flatnonzero(changed_bits.any(axis=1))
+        changed_bits = changed_bits[changed]
+        changed_source = source[changed]
+        changed_destination = destination[changed]
+        changed_capacity = self.capacity[changed]
+        changed_tree = tree[changed]
+        results = []
+        sums = []
+        counts = []
+        for depth in range(1, self.MAX_DEPTH + 1):
+            hop_sum = np.full(words * 64, base_hops[depth - 1] if depth <= len(base_hops) else 0, dtype=np.int64)
+            dropped = changed_tree & (base[changed_destination] == depth)
+            hop_sum -= bit_sums(changed_bits[dropped], changed_capacity[dropped])
+            added = at_level[depth - 1][changed_source] & at_level[depth][changed_destination] & changed_bits
+            kept = added.any(axis=1)
+            hop_sum += bit_sums(added[kept], changed_capacity[kept])
+            if depth == 1:
+                hop_sum += extra
+            sums += [hop_sum]
+            rows = base == depth
+            counts += [base_count[depth] - bit_sums(improved[rows]) + bit_sums(frontiers[depth])]
+        for bit in range(len(candidates)):
+            hop_sums = []
+            for depth in range(self.MAX_DEPTH):
+                if counts[depth][bit] == 0:
+                    break
+                hop_sums += [int(sums[depth][bit])]
+            results += [hop_sums]
+        return results
+
+
+class PubkeyTable:
+    # node ids of a mapped snapshot, decoded from their 33 raw bytes on access
+
+    def __init__(self, keys, order):
+        self.keys = keys
+        self.order = order
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, node):
+        return self.keys[node].tobytes().hex()
+
+    def __iter__(self):
+        for node in range(len(self.keys)):
+            yield self[node]
+
+    def find(self, node_id):
+        try:
+            key = bytes.fromhex(node_id)
+        except ValueError:
+            return None
+        (low, high) = (0, len(self.order))
+        while low < high:
+            middle = (low + high) // 2
+            if self.keys[self.order[middle]].tobytes() < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.order) and self.keys[self.order[low]].tobytes() == key:
+            return int(self.order[low])
+        return None
+
+
+class PubkeyIndex:
+
+    def __init__(self, table):
+        self.table = table
+
+    def __getitem__(self, node_id):
+        node = self.table.find(node_id)
+        if node is None:
+            raise KeyError(node_id)
+        return node
+
+    def __contains__(self, node_id):
+        return self.table.find(node_id) is not None
+
+
+def graph_snapshot_path(options):
+    # test runs keep a snapshot per fixture directory, apart from the real one
+    endpoint = rpc_endpoint(options)
+    if endpoint.startswith("test:"):
+        return LCW_TEST_GRAPH_PATH.format(hashlib.sha1(endpoint.encode()).hexdigest()[:12])
+    return LCW_GRAPH_PATH
+
+
+def load_graph(path, ttl, refresh):
+    if not refresh:
+        with TIMINGS.phase("graph.load"):
+            graph = ChannelGraph.load(path)
+        if graph is not None and NOW - graph.created < ttl:
+            print("using network snapshot from {} minutes ago".format((NOW - graph.created) // 60))
+            return graph
+    print("getting all channels...")
+    with TIMINGS.phase("graph.build"):
+        graph = ChannelGraph.from_channels(clapi.iter_listchannels(("source", "destination", "satoshis")))
+    with TIMINGS.phase("graph.save"):
+        graph.save(path)
+    return graph
+
+
+class GraphPool:
+    # Worker processes running ChannelGraph batch methods. The graph arrays are
+    # written once to a memory-mapped file and every worker maps that file
+    # instead of receiving its own pickled copy.
+
+    def __init__(self, graph, jobs):
+        self.jobs = jobs
+        shm = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        (handle, self.path) = tempfile.mkstemp(prefix="lcw-graph-", dir=shm)
+        os.close(handle)
+        layout = write_arrays(self.path, graph.shared_arrays())
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+                                                               initializer=init_graph_worker,
+                                                               initargs=(self.path, layout))
+
+    def map(self, method, batches, args):
+        return list(self.executor.map(run_graph_batch, itertools.repeat(method), batches, itertools.repeat(args)))
+
+    def close(self):
+        # also on errors and Ctrl-C: queued batches are dropped, the workers
+        # stop and the mapped file goes away
+        try:
+            self.executor.shutdown(cancel_futures=True)
+        finally:
+            os.unlink(self.path)
+
+
+def write_arrays(path, arrays, offset=0):
+    # arrays laid out back to back, 64-byte aligned; returns the layout
+    # map_arrays needs to map them again
+    layout = {}
+    with open(path, "r+b" if offset else "wb") as file:
+        for (name, array) in arrays.items():
+            offset = -(-offset // 64) * 64
+            file.seek(offset)
+            file.write(np.ascontiguousarray(array).tobytes())
+            layout[name] = (offset, array.shape, array.dtype.str)
+            offset += array.nbytes
+    return layout
+
+
+def map_arrays(path, layout):
+    arrays = {}
+    for (name, (offset, shape, dtype)) in layout.items():
+        if np.prod(shape) == 0:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=tuple(shape))
+    return arrays
+
+
+def init_graph_worker(path, layout):
+    global WORKER_GRAPH
+    WORKER_GRAPH = ChannelGraph.from_arrays(map_arrays(path, layout))
+
+
+def run_graph_batch(method, batch, args):
+    return getattr(WORKER_GRAPH, method)(batch, *args)
+
+
+@contextlib.contextmanager
+def graph_pool(graph, jobs):
+    # a GraphPool closed on leaving, None when the scan runs in this process
+    if jobs == 0:
+        jobs = multiprocessing.cpu_count()
+    if jobs <= 1:
+        yield None
+        return
+    pool = GraphPool(graph, jobs)
+    try:
+        yield pool
+    finally:
+        pool.close()
+
+
+def csr_ranges(indptr, nodes):
+    # positions of all the edges of the given nodes in a CSR layout
+    starts = indptr[nodes]
+    lengths = indptr[nodes + 1] - starts
+    offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return offsets + np.arange(lengths.sum())
+
+
+def hll_alpha(registers):
+    if registers == 16:
+        return 0.673
+    elif registers == 32:
+        return 0.697
+    elif registers == 64:
+        return 0.709
+    return 0.7213 / (1 + 1.079 / registers)
+
+
+def hll_estimate(counters):
+    registers = counters.shape[1]
+    estimate = hll_alpha(registers) * registers * registers / np.ldexp(1.0, -counters.astype(np.int32)).sum(axis=1)
+    zeros = (counters == 0).sum(axis=1)
+    small = (estimate <= 2.5 * registers) & (zeros > 0)
+    estimate[small] = registers * np.log(registers / zeros[small])
+    return estimate
+
+
+def hll_error(registers):
+    # relative standard error of a single HyperLogLog estimate
+    return 1.04 / np.sqrt(registers)
+
+
+def bit_sums(words, weights=None):
+    # for every bit position of a (rows, words) uint64 array, the sum of the
+    # weights of the rows where that bit is set (or the number of such rows)
+    totals = np.zeros(words.shape[1] * 64, dtype=np.int64)
+    for offset in range(0, len(words), BIT_SUMS_ROWS):
+        chunk = words[offset:offset + BIT_SUMS_ROWS].astype("<u8").view(np.uint8)
+        bits = np.unpackbits(chunk, axis=1, bitorder="little")
+        if weights is None:
+            totals += bits.sum(axis=0, dtype=np.int64)
+        else:
+            # capacities stay far below 2**53, so float sums are exact
+            chunk_weights = weights[offset:offset + BIT_SUMS_ROWS].astype(np.float64)
+            totals += np.rint(chunk_weights @ bits).astype(np.int64)
+    return totals
+
+
+def hop_list(hop_sums):
+    return [hop_sum / SATS_PER_BTC for hop_sum in hop_sums]
+
+
+def best_candidates(graph, node, candidates, amount, current_score, limit, score, pool=None):
+    # top limit candidates by score, best first, ties in candidate order.
+    # Candidates are scored in order of their upper bound and skipped once
+    # the bound can no longer beat current_score or the limit-th best.
+    args = (node, amount) + graph.base_levels(node)
+    (base, tree) = args[2:4]
+    bounds = np.floor(graph.candidate_bounds(node, candidates, amount, base, tree) * 1000 + 0.5 + 1e-6)
+    order = sorted(range(len(candidates)), key=lambda position: -bounds[position])
+    round_size = 64 * ChannelGraph.BATCH_WORDS * (pool.jobs if pool is not None else 1)
+    progress = sys.stderr.isatty()
+    top = []
+    scored = 0
+    started = time.time()
+    while order:
+        if len(top) == limit:
+            worst = top[0]
+        else:
+            worst = (current_score, 1)
+        order = [position for position in order if (bounds[position], -position) > worst]
+        if not order:
+            break
+        (batch, order) = (order[:round_size], order[round_size:])
+        hop_sums = graph.run_batches("candidate_batch",
+                                     graph.batches([candidates[position] for position in batch], pool),
+                                     args, pool)
+        for (position, sums) in zip(batch, hop_sums):
+            entry = (score(hop_list(sums)), -position)
+            if entry[0] <= current_score:
+                continue
+            if len(top) < limit:
+                heapq.heappush(top, entry)
+            elif entry > top[0]:
+                heapq.heapreplace(top, entry)
+        scored += len(batch)
+        if progress:
+            elapsed = time.time() - started
+            left = len(order)
+            sys.stderr.write("\rscored {}/{} candidates, {} pruned, ETA {:.0f}s ".format(
+                scored, len(candidates), len(candidates) - scored - left, elapsed / scored * left))
+            sys.stderr.flush()
+    if progress:
+        sys.stderr.write("\rscored {}/{} candidates, {} pruned in {:.1f}s\n".format(
+            scored, len(candidates), len(candidates) - scored, time.time() - started))
+    return [(candidates[-position], new_score) for (new_score, position) in sorted(top, reverse=True)]
+
+
+def ignore_channel(channel_id):
+    HistoryStore().ignore(channel_id)
+
+
+def status_command(my_node, options):
+    if options.channel is not None:
+        selected = []
+        for peer in my_node.listpeers["peers"]:
+            if peer["id"] == options.channel:
+                selected = [peer]
+                break
+            if options.channel in peer["id"]:
+                selected += [peer]
+                continue
+            for channel in peer["channels"]:
+                if channel["short_channel_id"] == options.channel:
+                    selected = [channel]
+                    break
+            if len(selected) > 0:
+                break
+            # search short channel ids
+        if selected:
+            for item in selected:
+                print(json.dumps(item, indent=3))
+                print("--------------------------")
+        else:
+            print("specified id not found in peers list")
+    else:
+        windows = None
+        if options.windows:
+            try:
+                windows = [int(window) for window in options.windows.split(",")]
+            except ValueError:
+                print("--windows expects a comma separated list of days")
+                exit(1)
+        if options.output_format != "table" and (windows or options.series):
+            print("--windows and --series are only shown with --format table")
+            exit(1)
+        my_node.print_status(verbosity=options.verbosity,
+                             sort_key=options.sort_key,
+                             limit=options.limit,
+                             filters=options.filters,
+                             windows=windows,
+                             output_format=options.output_format)
+        if options.series:
+            my_node.print_series()
+
+
+class FleetNode:
+    # one entry of the --fleet file: a name and how to reach its lightningd,
+    # with a history store of its own
+    def __init__(self, entry):
+        if not isinstance(entry, dict) or not isinstance(entry.get("name"), str):
+            raise ValueError("each node needs a name")
+        self.name = entry["name"]
+        if ("rpc_file" in entry) == ("cli" in entry):
+            raise ValueError("{}: set one of rpc_file or cli".format(self.name))
+        self.rpc_file = entry.get("rpc_file")
+        self.cli_command = shlex.split(entry["cli"]) if "cli" in entry else None
+        self.history_path = entry.get("history", LCW_FLEET_HISTORY_PATH.format(self.name))
+        self.node = None
+        self.stored = None
+        self.error = None
+        self.load_time = None
+
+    def load(self, options):
+        # refreshed Node, or the error that stopped it
+        start = time.perf_counter()
+        try:
+            api = CLightning(rpc_file=self.rpc_file, cli_command=self.cli_command)
+            # the legacy JSON file is the single node's history, not theirs
+            node = Node(since=options.since, api=api, history_path=self.history_path, legacy_path=None)
+            node.refresh()
+            if options.command == "store":
+                self.stored = node.store_today_data()
+            self.node = node
+        except Exception as e:
+            self.error = "{}: {}".format(type(e).__name__, e)
+        self.load_time = time.perf_counter() - start
+
+
+def load_fleet(path):
+    try:
+        with open(path) as file:
+            config = json.load(file)
+        fleet = [FleetNode(entry) for entry in config["nodes"]]
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print("invalid fleet file {}: {}".format(path, e))
+        exit(1)
+    names = [fleet_node.name for fleet_node in fleet]
+    if not fleet or len(set(names)) != len(names):
+        print("invalid fleet file {}: node names must be unique and there must be at least one".format(path))
+        exit(1)
+    return fleet
+
+
+def fleet_command(options):
+    # every node is loaded on a thread of its own, so the run takes as long
+    # as the slowest node; then one summary line per node and their total
+    if options.command not in ("status", "store"):
+        print("--fleet runs the status and store commands only")
+        exit(1)
+    fleet = load_fleet(options.fleet)
+    start = time.perf_counter()
+    with TIMINGS.phase("fleet.load"):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(fleet)) as executor:
+            list(executor.map(lambda fleet_node: fleet_node.load(options), fleet))
+    wall = time.perf_counter() - start
+    loaded = [fleet_node for fleet_node in fleet if fleet_node.node is not None]
+    if options.command == "status":
+        records = []
+        for fleet_node in fleet:
+            record = {"name": fleet_node.name, "load_time": fleet_node.load_time}
+            if fleet_node.node is not None:
+                node = fleet_node.node
+                record.update(since=node.since,
+                              wallet_confirmed=node.wallet_value_confirmed,
+                              wallet_unconfirmed=node.wallet_value_unconfirmed,
+                              wallet_total=node.total_wallet,
+                              **node.summary())
+            else:
+                record["error"] = fleet_node.error
+            records += [record]
+        total = {"name": "TOTAL", "load_time": wall, "since": None}
+        for name in ("wallet_confirmed", "wallet_unconfirmed", "wallet_total", "channel_count", "total_capacity",
+                     "input_capacity", "output_capacity", "routed_payments", "routed_amount", "node_value",
+                     "fees_collected"):
+            total[name] = sum(record[name] for record in records if "error" not in record)
+        total["routed_capacity"] = total["routed_amount"] / total["total_capacity"] * 2 \
+            if total["total_capacity"] else 0
+        write_fleet(records, total, options.output_format)
+    for fleet_node in fleet:
+        if fleet_node.stored is not None:
+            print("{}: {}".format(fleet_node.name, "stored" if fleet_node.stored else "today's data is already stored"))
+        if fleet_node.error is not None:
+            print("{}: {}".format(fleet_node.name, fleet_node.error), file=sys.stderr)
+    if len(loaded) < len(fleet):
+        exit(1)
+
+
+FLEET_FIELDS = ("name", "since", "channel_count", "wallet_confirmed", "wallet_unconfirmed", "wallet_total",
+                "total_capacity", "input_capacity", "output_capacity", "routed_payments", "routed_amount",
+                "routed_capacity", "node_value", "fees_collected", "load_time", "error")
+
+
+def write_fleet(records, total, output_format):
+    out = sys.stdout
+    if output_format == "csv":
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow(FLEET_FIELDS)
+        for record in records + [total]:
+            writer.writerow([record.get(name) for name in FLEET_FIELDS])
+    elif output_format == "ndjson":
+        for record in records + [total]:
+            out.write(json.dumps(record) + "\n")
+    elif output_format == "json":
+        out.write(json.dumps({"nodes": records, "total": total}) + "\n")
+    else:
+        lines = ["Fleet summary (BTC):\n",
+                 "  {:16s} {:>6s} {:>12s} {:>13s} {:>13s} {:>13s} {:>9s} {:>12s} {:>10s} {:>5s} {:>7s}\n".format(
+                     "node", "chans", "wallet", "capacity", "inbound", "outbound", "routed", "amount", "fees sat",
+                     "since", "load")]
+        for record in records + [total]:
+            if "error" in record:
+                lines += ["- {:16.16s} {:>101s} {:6.2f}s\n".format(record["name"], "FAILED",
+                                                                    record["load_time"])]
+                continue
+            lines += ["- {:16.16s} {:6d} {:12.8f} {:13.8f} {:13.8f} {:13.8f} {:9d} {:12.8f} {:10.0f} {:>5s} "
+                      "{:6.2f}s\n".format(record["name"],
+                                           record["channel_count"],
+                                           record["wallet_total"] / SATS_PER_BTC,
+                                           record["total_capacity"] / SATS_PER_BTC,
+                                           record["input_capacity"] / SATS_PER_BTC,
+                                           record["output_capacity"] / SATS_PER_BTC,
+                                           record["routed_payments"],
+                                           record["routed_amount"] / SATS_PER_BTC,
+                                           record["fees_collected"],
+                                           str(record["since"]) + "d" if record["since"] is not None else "-",
+                                           record["load_time"])]
+        lines += ["\n"]
+        out.write("".join(lines))
+
+
+def daemon_servable(options):
+    # read-only status queries on current counters, profiled and test runs stay local
+    return (options.command == "status" and options.since is None and options.ignored_channel is None
+            and not options.no_daemon and not options.timings and options.fleet is None
+            and not options.test_mode and options.profile is None and options.profile_memory is None)
+
+
+def rpc_endpoint(options):
+    # the lightningd a run talks to: a daemon only answers runs on the same one
+    if options.test_mode and not options.rpc_file:
+        return "test:" + os.getcwd()
+    if options.rpc_file:
+        return "rpc:" + os.path.abspath(options.rpc_file)
+    return "cli:{}".format(os.getenv(CLI_LIGHTNING_COMMAND_VARNAME))
+
+
+class DaemonServer(socketserver.UnixStreamServer):
+    # keeps a Node in memory, refreshed every interval seconds in the
+    # background, and runs status queries against it. A query is the argv of
+    # an lcw call as a JSON line; the reply is its output and exit status.
+    def __init__(self, path, interval, endpoint):
+        self.interval = interval
+        self.endpoint = endpoint
+        self.node = Node()
+        self.node.refresh(aliases=True)
+        self.node_time = time.time()
+        self.query_lock = threading.Lock()
+        self.stopped = threading.Event()
+        socketserver.UnixStreamServer.__init__(self, path, DaemonHandler)
+        self.refresher = threading.Thread(target=self.refresh_loop, daemon=True)
+        self.refresher.start()
+
+    def refresh_loop(self):
+        global NOW
+        while not self.stopped.wait(self.interval):
+            # every refresh and query runs at its own time, not the daemon's start
+            NOW = int(time.time())
+            try:
+                rpc = self.node.fetch(Node.CHANNEL_RPCS + ("aliases",))
+                with self.query_lock:
+                    self.node.update(rpc)
+            except (Exception, SystemExit) as e:
+                sys.stderr.write("node refresh failed: {}\n".format(e))
+                continue
+            self.node_time = time.time()
+
+    def query(self, argv):
+        global NOW
+        output = io.StringIO()
+        status = 0
+        # print_status writes to stdout: one query at a time
+        with self.query_lock, contextlib.redirect_stdout(output):
+            NOW = int(time.time())
+            try:
+                (options, args) = parser.parse_args(argv)
+                if not daemon_servable(options):
+                    raise ValueError("not a status query")
+                status_command(self.node, options)
+            except SystemExit as e:
+                status = e.code if isinstance(e.code, int) else 1
+            except Exception as e:
+                print("daemon query failed: {}".format(e))
+                status = 1
+        return {"output": output.getvalue(), "status": status, "age": time.time() - self.node_time,
+                "interval": self.interval, "endpoint": self.endpoint}
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
             return
-        history[today] = self.channels
-        file = open(LCW_DATA_PATH, "w")
-        file.write(json.dumps(stored_json))
-        file.close()
+        self.wfile.write(json.dumps(self.server.query(request["argv"])).encode() + b"\n")
+
+
+def run_daemon(path, interval, endpoint):
+    if os.path.exists(path):
+        if daemon_query(path, ["--command", "status", "-l", "1"]) is not None:
+            print("lcw daemon already running on {}".format(path))
+            exit(1)
+        os.unlink(path)
+    server = DaemonServer(path, interval, endpoint)
+    signal.signal(signal.SIGTERM, lambda signum, frame: exit(0))
+    print("lcw daemon serving on {}, refreshing every {}s".format(path, interval))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stopped.set()
+        server.server_close()
+        os.unlink(path)
+
+
+def daemon_query(path, argv):
+    # the daemon's reply, None when no daemon answers on path
+    if not os.path.exists(path):
+        return None
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+        connection.sendall(json.dumps({"argv": argv}).encode() + b"\n")
+        reply = b""
+        while True:
+            chunk = connection.recv(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            reply += chunk
+        return json.loads(reply)
+    except (OSError, ValueError):
+        return None
+    finally:
+        connection.close()
 
 
 parser = OptionParser()
@@ -620,12 +2970,33 @@ parser.add_option("-l", "--limit",
 
 parser.add_option("-f", "--filter",
                   action="append", type="string", dest="filters", default=[],
-                  help="Add a display filter")
+                  help="Add a display filter: [+|-]<expression> or one of or/and/not. "
+                       "Expressions combine channel fields with ( ) and or not, "
+                       "= <> < <= > >=, + - * / and ~ !~ (regex match)")
+
+parser.add_option("", "--format",
+                  action="store", type="choice", dest="output_format", default="table",
+                  choices=["table", "json", "ndjson", "csv"],
+                  help="status: table, or the listed channels with every field as json, ndjson or csv")
 
 parser.add_option("", "--force",
                   action="store_true", dest="force", default=False,
                   help="Do not skip 0 fees settings")
 
+parser.add_option("", "--dry-run",
+                  action="store_true", dest="dry_run", default=False,
+                  help="setfees: only print the fee changes that would be applied")
+
+parser.add_option("", "--sweep",
+                  action="store", type="string", dest="sweep", default=None,
+                  help="setfees: instead of setting fees, compare the --fees policies of a grid "
+                       "<k>/<offset>/<max>, each a list of values or start:stop:step ranges, "
+                       "e.g. 10:100:10/-100:0:20/1000,2000")
+
+parser.add_option("", "--sweep-days",
+                  action="store", type="int", dest="sweep_days", default=30,
+                  help="setfees --sweep: weigh fee changes by the outgoing volume of this # of days")
+
 parser.add_option("-s", "--sort",
                   action="store", type="string", dest="sort_key", default=None,
                   help="Sort channels with provided key")
@@ -638,6 +3009,15 @@ parser.add_option("", "--since",
                   action="store", type="int", dest="since", default=None,
                   help="Payments and derived stats are counted from given # of days")
 
+parser.add_option("", "--windows",
+                  action="store", type="string", dest="windows", default=None,
+                  help="status: payments, amount and settle rate of the listed channels over "
+                       "these # of days, e.g. 1,7,30,90 (closest stored day as reference)")
+
+parser.add_option("", "--series",
+                  action="store_true", dest="series", default=False,
+                  help="status: payments and amount routed between each stored day")
+
 parser.add_option("", "--amount",
                   action="store", type="int", dest="amount", default=15000000,
                   help="Amount for new channel when searching for best peers")
@@ -663,10 +3043,79 @@ parser.add_option("", "--bestnodes",
                   action="store_true", dest="bestnodes", default=False,
                   help="Search for best connected nodes")
 
+parser.add_option("", "--approx",
+                  action="store_true", dest="approx", default=False,
+                  help="bestnodes: rank by approximate reach (HyperLogLog) in one pass over the graph")
+
+parser.add_option("", "--registers",
+                  action="store", type="int", dest="registers", default=64,
+                  help="Number of HyperLogLog registers per node for --approx (power of 2)")
+
+parser.add_option("", "--recheck",
+                  action="store", type="int", dest="recheck", default=0,
+                  help="With --approx, compute exact centrality scores for the top N nodes")
+
+parser.add_option("", "--graph-ttl",
+                  action="store", type="int", dest="graph_ttl", default=3600,
+                  help="analyze: reuse the network snapshot if younger than this many seconds")
+
+parser.add_option("", "--refresh",
+                  action="store_true", dest="refresh", default=False,
+                  help="analyze: fetch the network again instead of using the snapshot")
+
+parser.add_option("-j", "--jobs",
+                  action="store", type="int", dest="jobs", default=1,
+                  help="analyze: number of worker processes for exact scans (0: one per CPU)")
+
 parser.add_option("", "--node",
                   action="store", type="string", dest="node", default=None,
                   help="Analyze node")
 
+parser.add_option("", "--rpc-file",
+                  action="store", type="string", dest="rpc_file",
+                  default=os.getenv(LIGHTNING_RPC_FILE_VARNAME),
+                  help="Path of lightningd's lightning-rpc socket. Defaults to ${} "
+                       "and falls back to $CLI_LIGHTNING_COMMAND when unset".format(LIGHTNING_RPC_FILE_VARNAME))
+
+parser.add_option("", "--fleet",
+                  action="store", type="string", dest="fleet", default=None,
+                  help="status and store on every node of this JSON file at once: "
+                       "{\"nodes\": [{\"name\": ..., \"rpc_file\": ... or \"cli\": ...}, ...]}. "
+                       "status prints one summary line per node and their total")
+
+parser.add_option("", "--daemon",
+                  action="store_true", dest="daemon", default=False,
+                  help="Keep the node state in memory and serve status queries on --daemon-socket")
+
+parser.add_option("", "--daemon-socket",
+                  action="store", type="string", dest="daemon_socket", default=LCW_DAEMON_PATH,
+                  help="Unix socket of the lcw daemon. status queries go through it when a daemon is running")
+
+parser.add_option("", "--daemon-interval",
+                  action="store", type="int", dest="daemon_interval", default=60,
+                  help="daemon: seconds between two refreshes of the node state")
+
+parser.add_option("", "--no-daemon",
+                  action="store_true", dest="no_daemon", default=False,
+                  help="Query lightningd directly even when a daemon is running")
+
+parser.add_option("", "--timings",
+                  action="store_true", dest="timings", default=False,
+                  help="Print the time spent in each phase and lightningd call to stderr")
+
+parser.add_option("", "--timings-file",
+                  action="store", type="string", dest="timings_file", default=os.getenv(LCW_TIMINGS_FILE_VARNAME),
+                  help="Append the timings of the run as a JSON line to this file. "
+                       "Defaults to ${}".format(LCW_TIMINGS_FILE_VARNAME))
+
+parser.add_option("", "--profile",
+                  action="store", type="string", dest="profile", default=None,
+                  help="Write a cProfile dump of the run to this file")
+
+parser.add_option("", "--profile-memory",
+                  action="store", type="string", dest="profile_memory", default=None,
+                  help="Trace allocations with tracemalloc and write the snapshot to this file")
+
 parser.add_option("", "--command",
                   action="store", type="string", dest="command", default="status",
                   help="store: Store current channels information into json history file\n"
@@ -675,286 +3124,282 @@ parser.add_option("", "--command",
                        "analyze:\n"
                   )
 
-(options, args) = parser.parse_args()
-
-clapi = CLightning(test_mode=options.test_mode)
-
-if options.command != "status":
-    options.since = None
-
-my_node = Node(since=options.since)
-
-
-def ignore_channel(channel_id):
-    stored_data = file_content(LCW_DATA_PATH)
-    if stored_data is None:
-        stored_json = {}
-    else:
-        stored_json = stored_data
-    if "ignored" in stored_json:
-        ignored = stored_json["ignored"]
-    else:
-        ignored = []
-        stored_json["ignored"] = ignored
-    ignored += [channel_id]
-    file = open(LCW_DATA_PATH, "w")
-    file.write(json.dumps(stored_json))
-    file.close()
-
-
-if options.command == "store":
-    my_node.store_today_data()
-elif options.ignored_channel:
-    ignore_channel(options.ignored_channel)
-elif options.command == "setfees":
-    fees = options.fees.split("/")
-    my_node.set_fees(options.force, int(fees[0]), int(fees[1]), int(fees[2]))
-elif options.command == "status":
-    if options.channel is not None:
-        selected = []
-        for peer in my_node.listpeers["peers"]:
-            if peer["id"] == options.channel:
-                selected = [peer]
-                break
-            if options.channel in peer["id"]:
-                selected += [peer]
-                continue
-            for channel in peer["channels"]:
-                if channel["short_channel_id"] == options.channel:
-                    selected = [channel]
-                    break
-            if len(selected) > 0:
-                break
-            # search short channel ids
-        if selected:
-            for item in selected:
-                print(json.dumps(item, indent=3))
-                print("--------------------------")
-        else:
-            print("specified id not found in peers list")
-    else:
-        my_node.print_status(verbosity=options.verbosity,
-                             sort_key=options.sort_key,
-                             limit=options.limit,
-                             filters=options.filters)
-elif options.command == "analyze":
-    print("getting all channels...")
-    channels = clapi.listchannels()
-    print("building the network...")
-    nodes = {}
-    for channel in channels["channels"]:
-        source = channel["source"]
-        if source in nodes:
-            node = nodes[source]
-        else:
-            node = munch.Munch(
-                node_id=source,
-                channels=[]
-            )
-            nodes[source] = node
-        node.channels += [munch.Munch.fromDict(channel)]
-        # if "satoshis" not in channel:
-        #     print(channel)
-
-
-    def centrality_map2(node_id, new_peer=None, without_index=None):
-        start_node = nodes[node_id]
-        removed_channel = None
-        if new_peer is not None:
-            start_node.channels += [munch.Munch(source=node_id,
-                                                destination=new_peer[0],
-                                                public=True,
-                                                satoshis=new_peer[1])]
-        elif without_index is not None:
-            removed_channel = start_node.channels.pop(without_index)
-        visited = {}
-        newly_visited = {}
-        visited[start_node.node_id] = (start_node, 0)
-        newly_visited[start_node.node_id] = (start_node, 0)
-        hops = []
-        for depth in range(1, 10):
-            next_newly_visited = {}
-            for neighbour in newly_visited.values():
-                for channel in neighbour[0].channels:
-                    # if not channel.public:
-                    #     continue
-                    if channel.destination not in nodes:
-                        pass
-                        # print("node not found: " + channel.destination)
-                    else:
-                        new_node = nodes[channel.destination]
-                        if new_node.node_id not in visited and new_node.node_id not in newly_visited:
-                            if new_node.node_id in next_newly_visited:
-                                old_entry = next_newly_visited[new_node.node_id]
-                                next_newly_visited[new_node.node_id] = (new_node, old_entry[1] + channel.satoshis)
-                            else:
-                                next_newly_visited[new_node.node_id] = (new_node, channel.satoshis)
-            # print("{} hops: {} nodes".format(depth, len(next_newly_visited)))
-            visited.update(newly_visited)
-            newly_visited = next_newly_visited
-            if len(newly_visited) == 0:
-                break
+@contextlib.contextmanager
+def instrumented(options):
+    # --profile, --profile-memory, --timings and --timings-file around a run
+    profile = None
+    if options.profile_memory is not None:
+        tracemalloc.start(25)
+    if options.profile is not None:
+        profile = cProfile.Profile()
+        profile.enable()
+    status = 0
+    try:
+        yield
+    except SystemExit as e:
+        status = e.code if e.code is not None else 0
+        raise
+    except BaseException:
+        status = None
+        raise
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(options.profile)
+            print("cpu profile written to {0}, read it with: python3 -m pstats {0}".format(options.profile),
+                  file=sys.stderr)
+        if options.profile_memory is not None:
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            snapshot.dump(options.profile_memory)
+            print("allocations: {:.1f} MB peak, snapshot written to {}, largest:".format(
+                peak / 1000000, options.profile_memory), file=sys.stderr)
+            imports = [tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                       tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>")]
+            for statistic in snapshot.filter_traces(imports).statistics("lineno")[:10]:
+                print("- {}".format(statistic), file=sys.stderr)
+        if options.timings:
+            TIMINGS.report(sys.stderr)
+        if options.timings_file is not None:
+            record = TIMINGS.record(sys.argv[1:])
+            record["status"] = status
+            try:
+                with open(options.timings_file, "a") as file:
+                    file.write(json.dumps(record) + "\n")
+            except OSError as e:
+                print("cannot write timings to {}: {}".format(options.timings_file, e), file=sys.stderr)
+
+
+def main():
+    (options, args) = parser.parse_args()
+    with instrumented(options):
+        run_command(options)
+
+
+def run_command(options):
+    global clapi
+
+    if not options.daemon and daemon_servable(options):
+        with TIMINGS.phase("daemon.query"):
+            reply = daemon_query(options.daemon_socket, sys.argv[1:])
+        if reply is not None and reply.get("endpoint") == rpc_endpoint(options):
+            if reply["age"] <= DAEMON_STALE_REFRESHES * reply["interval"]:
+                sys.stdout.write(reply["output"])
+                exit(reply["status"])
+            print("lcw daemon data is {:.0f}s old, querying lightningd directly".format(reply["age"]),
+                  file=sys.stderr)
+
+    if options.ignored_channel and options.command != "store":
+        ignore_channel(options.ignored_channel)
+        return
+
+    if options.command != "status":
+        options.since = None
+
+    if options.fleet is not None:
+        fleet_command(options)
+        return
+
+    clapi = CLightning(test_mode=options.test_mode, rpc_file=options.rpc_file)
+
+    if options.daemon:
+        run_daemon(options.daemon_socket, options.daemon_interval, rpc_endpoint(options))
+        return
+
+    # each command fetches what it uses up front, anything else is fetched
+    # on first access
+    my_node = Node(since=options.since)
+
+    if options.command == "store":
+        my_node.refresh()
+        if not my_node.store_today_data():
+            print("today's data is already stored")
+    elif options.command == "setfees":
+        my_node.refresh()
+        if options.sweep is not None:
+            try:
+                parts = [sweep_values(part) for part in options.sweep.split("/")]
+                if len(parts) != 3:
+                    raise ValueError(options.sweep)
+            except ValueError:
+                print("--sweep expects <k>/<offset>/<max>, each a list of values or start:stop:step ranges")
+                exit(1)
+            my_node.fee_sweep(options.force, list(itertools.product(*parts)), options.sweep_days,
+                              options.limit if options.limit > 0 else 20)
+            return
+        fees = options.fees.split("/")
+        my_node.set_fees(options.force, int(fees[0]), int(fees[1]), int(fees[2]), dry_run=options.dry_run)
+    elif options.command == "status":
+        if options.channel is None:
+            my_node.refresh(aliases=True)
+        status_command(my_node, options)
+    elif options.command == "analyze":
+        my_node.prefetch("getinfo", "listnodes")
+        graph = load_graph(graph_snapshot_path(options), options.graph_ttl, options.refresh)
+
+
+        def centrality_map2(node_id, new_peer=None, without_index=None):
+            if new_peer is not None:
+                new_peer = (graph.index[new_peer[0]], new_peer[1])
+            with TIMINGS.phase("analyze.bfs"):
+                (levels, hop_sums) = graph.bfs(graph.index[node_id], new_peer=new_peer, without_index=without_index)
+            return hop_list(hop_sums)
+
+
+        def centrality_map1(node_id, new_peer=None, without_index=None):
+            if new_peer is not None:
+                new_peer = (graph.index[new_peer], 0)
+            (levels, hop_sums) = graph.bfs(graph.index[node_id], new_peer=new_peer, without_index=without_index)
+            return [int(count) for count in np.bincount(levels[levels > 0])[1:]]
+
+
+        def centrality_score(hops):
+            depth = 1
+            wsum = 0
             hop_sum = 0
-            for (node, sats) in newly_visited.values():
-                # print(node_entry)
-                hop_sum += sats
-            hops += [hop_sum / SATS_PER_BTC]
-        if new_peer is not None:
-            start_node.channels.pop()
-        elif without_index is not None:
-            start_node.channels.insert(without_index, removed_channel)
-        return hops
-
-
-    def centrality_map1(node_id, new_peer=None, without_index=None):
-        start_node = nodes[node_id]
-        removed_channel = None
-        if new_peer is not None:
-            start_node.channels += [munch.Munch(source=node_id,
-                                                destination=new_peer,
-                                                public=True)]
-        elif without_index is not None:
-            removed_channel = start_node.channels.pop(without_index)
-        visited = {}
-        newly_visited = {}
-        visited[start_node.node_id] = start_node
-        newly_visited[start_node.node_id] = start_node
-        hops = []
-        for depth in range(1, 10):
-            next_newly_visited = {}
-            for neighbour in newly_visited.values():
-                for channel in neighbour.channels:
-                    # if not channel.public:
-                    #     continue
-                    if channel.destination not in nodes:
-                        pass
-                        # print("node not found: " + channel.destination)
-                    else:
-                        new_node = nodes[channel.destination]
-                        if new_node.node_id not in visited and new_node.node_id not in newly_visited:
-                            next_newly_visited[new_node.node_id] = new_node
-            # print("{} hops: {} nodes".format(depth, len(next_newly_visited)))
-            visited.update(newly_visited)
-            newly_visited = next_newly_visited
-            if len(newly_visited) == 0:
-                break
-            hops += [len(newly_visited)]
-        if new_peer is not None:
-            start_node.channels.pop()
-        elif without_index is not None:
-            start_node.channels.insert(without_index, removed_channel)
-        return hops
-
-
-    def centrality_score(hops):
-        depth = 1
-        wsum = 0
-        hop_sum = 0
-        for hop in hops:
-            wsum += hop * (1 / depth)
-            depth += 1
-            hop_sum += hop
-        wsum /= hop_sum
-        return round(wsum * 1000)
-
-
-    def analyze(node_id, new_peer=None):
-        print("Node {} {}".format(my_node.hashed_listnodes[node_id], node_id))
-        hops = centrality_map2(node_id, new_peer=new_peer)
-        print("- hops: {}".format(hops))
-        score = centrality_score(hops)
-        print("- centrality score: {}".format(score))
-        return score
-
-
-    if options.node is not None:
-        if options.node == "self":
-            node_id = my_node.id
-        else:
-            node_id = options.node
-        print("Node {} {}".format(my_node.hashed_listnodes[node_id], node_id))
-        channel_hops = centrality_map2(node_id)
-        print("- hops: {}".format(channel_hops))
-        score = centrality_score(channel_hops)
-        print("- centrality score: {}".format(score))
-    elif options.bestpeers:
-        print("Searching for best connectivity peers with new capacity: {} sats".format(options.amount))
-        if options.limit > 0:
-            limit = options.limit
-        else:
-            limit = 15
-        current_score = analyze(my_node.id)
-        score_board = []
-        for node in nodes.values():
-            if len(node.channels) < 25:
-                continue
-            channel_hops = centrality_map2(my_node.id, new_peer=(node.node_id, options.amount))
-            new_score = centrality_score(channel_hops)
-            if new_score <= current_score:
-                continue
-            score_board += [(node, new_score)]
-            score_board.sort(key=lambda x: x[1], reverse=True)
-            count = 0
+            for hop in hops:
+                wsum += hop * (1 / depth)
+                depth += 1
+                hop_sum += hop
+            wsum /= hop_sum
+            return round(wsum * 1000)
+
+
+        def analyze(node_id, new_peer=None):
+            print("Node {} {}".format(my_node.hashed_listnodes[node_id], node_id))
+            hops = centrality_map2(node_id, new_peer=new_peer)
+            print("- hops: {}".format(hops))
+            score = centrality_score(hops)
+            print("- centrality score: {}".format(score))
+            return score
+
+
+        if options.node is not None:
+            if options.node == "self":
+                node_id = my_node.id
+            else:
+                node_id = options.node
+            print("Node {} {}".format(my_node.hashed_listnodes[node_id], node_id))
+            channel_hops = centrality_map2(node_id)
+            print("- hops: {}".format(channel_hops))
+            score = centrality_score(channel_hops)
+            print("- centrality score: {}".format(score))
+        elif options.bestpeers:
+            print("Searching for best connectivity peers with new capacity: {} sats".format(options.amount))
+            if options.limit > 0:
+                limit = options.limit
+            else:
+                limit = 15
+            current_score = analyze(my_node.id)
+            candidates = [node for node in graph.source_order() if graph.channel_count[node] >= 25]
+            with graph_pool(graph, options.jobs) as pool, TIMINGS.phase("analyze.candidates"):
+                score_board = best_candidates(graph, graph.index[my_node.id], candidates, options.amount,
+                                              current_score, limit, centrality_score, pool)
             print()
-            for score in score_board:
-                count += 1
+            for (count, (node, score)) in enumerate(score_board, 1):
+                node_id = graph.node_ids[node]
                 print("{:3d}  {:24.24} {}: {} ({:+d})".format(count,
-                                                              filter_alias(my_node.hashed_listnodes[score[0].node_id]),
-                                                              score[0].node_id,
-                                                              score[1],
-                                                              score[1] - current_score))
-                if count == limit:
-                    break
-            print()
-    elif options.bestnodes:
-        print("Searching for best connected nodes")
-        if options.limit > 0:
-            limit = options.limit
-        else:
-            limit = 15
-        score_board = []
-        for node in nodes.values():
-            if len(node.channels) < 25:
-                continue
+                                                              filter_alias(my_node.hashed_listnodes[node_id]),
+                                                              node_id,
+                                                              score,
+                                                              score - current_score))
             print()
-            channel_hops = centrality_map2(node.node_id)
-            new_score = centrality_score(channel_hops)
-            score_board += [(node, new_score)]
+        elif options.bestnodes and options.approx:
+            registers = options.registers
+            if registers < 16 or registers & (registers - 1):
+                print("--registers must be a power of 2, at least 16")
+                exit(1)
+            print("Estimating reach of every node with {} HyperLogLog registers".format(registers))
+            if options.limit > 0:
+                limit = options.limit
+            else:
+                limit = 15
+            with TIMINGS.phase("analyze.hyperanf"):
+                reach = graph.hyperanf(registers)
+            error = hll_error(registers)
+            score_board = []
+            for node in graph.source_order():
+                if graph.channel_count[node] < 25:
+                    continue
+                # an empty depth keeps its place so later hops keep their weight
+                hops = [max(hop, 0) for hop in reach[node]]
+                if sum(hops) > 0:
+                    score_board += [(graph.node_ids[node], centrality_score(hops), sum(hops))]
             score_board.sort(key=lambda x: x[1], reverse=True)
-            count = 0
-            print()
-            for score in score_board:
-                count += 1
-                print("{:3d}  {:24.24} {}: {}".format(count,
-                                                      filter_alias(my_node.hashed_listnodes[score[0].node_id]),
-                                                      score[0].node_id,
-                                                      score[1]))
-                if count == limit:
-                    break
-    elif options.channels:
-        channels = nodes[my_node.id].channels
-        index = 0
-        hops = centrality_map2(my_node.id)
-        node_score = centrality_score(hops)
-        print("Node current score: {}".format(node_score))
-        no_contrib_aliases = []
-        for channel in channels:
-            channel_hops = centrality_map2(channel.destination)
-            channel_score = centrality_score(channel_hops)
-            node_hops = centrality_map2(my_node.id, without_index=index)
-            contrib_score = centrality_score(node_hops)
-            contrib = node_score - contrib_score
-            alias = filter_alias(my_node.hashed_listnodes[channel.destination])
-            if contrib > 0:
-                print("{:24.24} {} {:8d}: {} {:+d}".format(alias,
-                                                           channel.destination,
-                                                           channel.satoshis,
-                                                           channel_score,
-                                                           contrib))
+            print("Approximate reach scores (reach within {} hops, +/- {:.1%}):".format(ChannelGraph.MAX_DEPTH, error))
+            for (count, score) in enumerate(score_board[:limit], 1):
+                print("{:3d}  {:24.24} {}: {} ({:.0f} +/- {:.0f} nodes)".format(count,
+                                                                              filter_alias(my_node.hashed_listnodes[score[0]]),
+                                                                              score[0],
+                                                                              score[1],
+                                                                              score[2],
+                                                                              score[2] * error))
+            if options.recheck > 0:
+                print()
+                print("Exact centrality scores of the top {}:".format(options.recheck))
+                exact_board = []
+                for score in score_board[:options.recheck]:
+                    exact_board += [(score[0], centrality_score(centrality_map2(score[0])))]
+                exact_board.sort(key=lambda x: x[1], reverse=True)
+                for (count, score) in enumerate(exact_board, 1):
+                    print("{:3d}  {:24.24} {}: {}".format(count,
+                                                          filter_alias(my_node.hashed_listnodes[score[0]]),
+                                                          score[0],
+                                                          score[1]))
+        elif options.bestnodes:
+            print("Searching for best connected nodes")
+            if options.limit > 0:
+                limit = options.limit
             else:
-                no_contrib_aliases += [alias]
-            index += 1
-        print("No connectivity contribution: " + ", ".join(no_contrib_aliases))
+                limit = 15
+            candidates = [node for node in graph.source_order() if graph.channel_count[node] >= 25]
+            with graph_pool(graph, options.jobs) as pool, TIMINGS.phase("analyze.hops"):
+                candidate_hops = graph.multi_source_hops(candidates, pool)
+            score_board = []
+            for (node, hop_sums) in zip(candidates, candidate_hops):
+                print()
+                node_id = graph.node_ids[node]
+                new_score = centrality_score(hop_list(hop_sums))
+                score_board += [(node_id, new_score)]
+                score_board.sort(key=lambda x: x[1], reverse=True)
+                count = 0
+                print()
+                for score in score_board:
+                    count += 1
+                    print("{:3d}  {:24.24} {}: {}".format(count,
+                                                          filter_alias(my_node.hashed_listnodes[score[0]]),
+                                                          score[0],
+                                                          score[1]))
+                    if count == limit:
+                        break
+        elif options.channels:
+            node = graph.index[my_node.id]
+            channels = graph.channels_of(node)
+            hops = centrality_map2(my_node.id)
+            node_score = centrality_score(hops)
+            print("Node current score: {}".format(node_score))
+            with TIMINGS.phase("analyze.hops"):
+                peer_hops = graph.multi_source_hops(graph.channel_destination[channels])
+            with TIMINGS.phase("analyze.contribution"):
+                contribution_hops = graph.contribution_hops(node)
+            no_contrib_aliases = []
+            for (channel, channel_hop_sums, node_hop_sums) in zip(channels, peer_hops, contribution_hops):
+                destination = graph.node_ids[graph.channel_destination[channel]]
+                channel_score = centrality_score(hop_list(channel_hop_sums))
+                contrib_score = centrality_score(hop_list(node_hop_sums))
+                contrib = node_score - contrib_score
+                alias = filter_alias(my_node.hashed_listnodes[destination])
+                if contrib > 0:
+                    print("{:24.24} {} {:8d}: {} {:+d}".format(alias,
+                                                               destination,
+                                                               graph.channel_satoshis[channel],
+                                                               channel_score,
+                                                               contrib))
+                else:
+                    no_contrib_aliases += [alias]
+            print("No connectivity contribution: " + ", ".join(no_contrib_aliases))
+
 
 """
 print(clapi.getinfo())
@@ -976,3 +3421,7 @@ else:
 args = [1,2,3]
 print("{} {} {}".format(*args))
 """
+
+
+if __name__ == "__main__":
+    main()